@@ -34,12 +34,170 @@ Notes from DK (all 3 sections below):
 """
 
 import time
-import pandas as pd
-import numpy as np
+from contextlib import contextmanager
 import ccep_utils as u
 import ccep_datavars as dv
 
-def run_module(db, state, county_name, county_code, op_path, srid, ssl, fssl, state_srid, mts_in_pt05mile):
+# Write the block/grid intersection and per-cell population tables
+# (temp_intersection_df, table_grid_block_pop), for debugging population calculations
+write_debug_tables = False
+
+# Split the county outline, roads and blocks into pieces of at most subdivide_max_vertices
+# vertices (ST_Subdivide), in indexed helper tables. These are only used to find which 
+# geometries intersect (steps 01, 04, 12, 14, 16, 22), the results use the original geometries,
+# so outputs are the same. Faster for large counties with detailed outlines and long roads.
+subdivide_geoms = False
+subdivide_max_vertices = 256
+
+# Lower write load on a shared database server:
+# - scratch tables (only used within CCEP1) are created UNLOGGED, i.e. not written to the WAL. 
+#   They are faster to write, but emptied if the server crashes, which is fine for scratch tables.
+# - related steps run in one transaction each, instead of committing every statement
+# - scratch tables are dropped at the end of the run
+unlogged_mode = False
+
+# Run the independent extraction steps (00a-08) concurrently, each on its own connection,
+# with up to parallel_workers at a time. Steps wait only for the county tables they use.
+# (Transactions from unlogged_mode are not used for these steps when running in parallel.)
+parallel_extract = False
+parallel_workers = 4
+
+# POI classes used for suitable sites (both lists), and for the CCEP6 POI files
+gov_poi_classes = ['post_office','fire_station','library','town_hall','police',
+                   'public_building','courthouse','embassy']
+misc_poi_classes = ['school','hospital','kindergarten','community_centre','arts_centre',
+                    'college','university','mall','nursing_home','supermarket',
+                    'hostel','motel','cafe']
+
+# Tables written for each county by run_statewide, i.e. the ones used by later modules
+statewide_county_tables = ['county','tracts','blocks','pois','pois_gov','pois_misc',
+                           'grid','grid_wdata','suitable_sites_raw_centroid']
+
+# POIs within this distance of a grid cell are attached to it (step 16). 
+# Originally .002 degrees, which is ~220m north-south, and less east-west.
+voting_poi_classes = gov_poi_classes + misc_poi_classes
+voting_poi_distance_mts = 200
+
+def sql_list(values):
+    """List of strings as a quoted, comma separated list for sql in ()"""
+    return ", ".join(f"'{v}'" for v in values)
+
+def voting_poi_counts(table_alias='b'):
+    """Columns for the number of POIs of each voting POI class, e.g. num_school"""
+    return ",\n".join(f"count(*) filter (where {table_alias}.fclass = '{c}')::int num_{c}" 
+                      for c in voting_poi_classes)
+
+def create_voting_pois(db, state, ssl, state_srid):
+    """
+    Voting POIs for the whole state, with geometry projected to state_srid (geom_m)
+    and a spatial index on it. Shared by all counties in the state, and only rebuilt 
+    if the state POIs (row count, max gid) or voting_poi_classes changed since it was 
+    built - these are saved in the table's comment.
+    The check and rebuild run in one transaction, holding an advisory lock for the state,
+    so counties run in parallel don't rebuild it at the same time or read it half-built.
+    """
+    voting_pois = f"{ssl}.{state}_voting_pois"
+    desc = "16a - Create state-wide voting POIs (if they don't exist or are out of date)"
+    with db.transaction():
+        # Released at the end of the transaction. A second county waits here, then finds it up to date.
+        db.qry(f"""select pg_advisory_xact_lock(hashtext('{state}_voting_pois'))""")
+        num_pois, max_gid = db.qry(f"""select count(*), max(gid) from {dv.osm}.{state}_pois""").fetchone()
+        source = f"{dv.osm}.{state}_pois rows={num_pois} max_gid={max_gid} classes={','.join(voting_poi_classes)}"
+        if db.qry(f"""select to_regclass('{voting_pois}')""").scalar() is not None:
+            built_from = db.qry(f"""select obj_description('{voting_pois}'::regclass, 'pg_class')""").scalar()
+            if built_from == source:
+                print(f"{u.getTimeNowStr()} {desc}: {voting_pois} is up to date, not rebuilt")
+                return voting_pois
+            print(f"{u.getTimeNowStr()} {desc}: {voting_pois} was built from '{built_from}', rebuilding")
+        qry_text = f"""
+            drop table if exists {voting_pois};
+            create table {voting_pois} as
+            select gid, fclass, name, geom, st_transform(geom, {state_srid}) geom_m
+            from {dv.osm}.{state}_pois 
+            where fclass in ({sql_list(voting_poi_classes)}) 
+                and (name not like '%(historical%)' or name is null);
+            create index on {voting_pois} using gist(geom_m);
+            analyze {voting_pois};
+            comment on table {voting_pois} is '{source}';
+        """
+        u.run_query(desc, db, qry_text)
+    return voting_pois
+
+# Scratch tables created by run_module, for county_name
+def scratch_tables(county_name):
+    return [f"{county_name}_{table}" for table in 
+            ['grid_p05miles','grid_intx','temp_grid_voting_pois',
+             'county_subdiv','roads_subdiv','blocks_subdiv']]
+
+# "unlogged" for create {scratch} table, if in unlogged_mode
+def scratch():
+    return "unlogged" if unlogged_mode else ""
+
+# Run a group of steps in one transaction, if in unlogged_mode:
+#     with steps_transaction(db):
+#         ...
+# If a step fails, the whole group is rolled back and the error is raised
+@contextmanager
+def steps_transaction(db):
+    if not unlogged_mode:
+        yield
+        return
+    with db.transaction():
+        yield
+
+def drop_scratch_tables(db, ssl, county_name):
+    desc = "27 - Drop scratch tables"
+    qry_text = "".join(f"""drop table if exists {ssl}.{table};\n""" for table in scratch_tables(county_name))
+    u.run_query(desc, db, qry_text)
+
+def subdivide_sql(source_table, subdiv_table, id_col, where=None):
+    """Sql for a helper table of source_table's geometries split by ST_Subdivide, with the source id"""
+    where_clause = f"where {where}" if where else ""
+    return f"""
+        drop table if exists {subdiv_table};
+        create {scratch()} table {subdiv_table} as
+        select {id_col}, st_subdivide(geom, {subdivide_max_vertices}) geom
+        from {source_table} {where_clause};
+        create index on {subdiv_table} using gist(geom);
+        analyze {subdiv_table};
+    """
+
+def create_subdivided(db, desc, source_table, subdiv_table, id_col, where=None):
+    u.run_query(desc, db, subdivide_sql(source_table, subdiv_table, id_col, where))
+
+def write_centroids_csv(db, ssl, table, op_file):
+    """
+    Write the suitable site centroids table to csv (without geom), streamed from the database,
+    formatted as it was when the csv was written from pandas (CCEP3 and R read it as text):
+    - poi_classes as a python-style list, e.g. ['school', 'library'] (empty if no POIs)
+    - integer columns with nulls (e.g. num_poi) as floats, e.g. 2.0, since pandas 
+      converted those columns to float
+    The per-class POI counts (num_<class>, step 17) are left out - they are only kept in the 
+    table, so the csv has the columns R and CCEP3 expect.
+    """
+    col_types = dict(db.qry(f"""select column_name, data_type from information_schema.columns 
+        where table_schema = '{ssl}' and table_name = '{table}'""").fetchall())
+    poi_count_columns = [f"num_{c}" for c in voting_poi_classes]
+    columns = [col for col in db.table_columns(ssl, table) if col != 'geom' and col not in poi_count_columns]
+    int_columns = [col for col in columns if col_types[col] in ('smallint', 'integer', 'bigint')]
+    nullable_int_columns = []
+    if int_columns:
+        null_counts = db.qry(f"""select {', '.join(f"count(*) - count({col})" for col in int_columns)} 
+            from {ssl}.{table}""").fetchone()
+        nullable_int_columns = [col for col, num_nulls in zip(int_columns, null_counts) if num_nulls > 0]
+    select_cols = []
+    for col in columns:
+        if col == 'poi_classes':
+            select_cols.append(f"""'[' || (select string_agg('''' || c || '''', ', ' order by n)
+                from unnest(poi_classes) with ordinality as t(c, n)) || ']' poi_classes""")
+        elif col in nullable_int_columns:
+            select_cols.append(f"""{col}::text || '.0' {col}""")
+        else:
+            select_cols.append(col)
+    db.table2csv(ssl, table, op_file, columns=select_cols)
+
+# Steps 00-26 of run_module
+def create_suitable_sites(db, state, county_name, county_code, op_path, srid, ssl, fssl, state_srid, mts_in_pt05mile):
     # Requires osm.XX_roads, osm.XX_pois
     # Requires admin_bounds.XX_counties, admin_bounds.XX_tracts, admin_bounds.XX_blocks
    
@@ -53,8 +211,40 @@ def run_module(db, state, county_name, county_code, op_path, srid, ssl, fssl, st
     
     op_path_ccep1 = f"{op_path}\CCEP1_Master_County_Suitable_Sites"
     
+    # Indexes are created only if they don't exist yet, and are named after their table, 
+    # so several counties can be processed at the same time against the same database
+    desc = "00 - Index state-wide tables used to extract the county"
+    print(f"{u.getTimeNowStr()} Run query: {desc}")
+    t0 = time.time()
+    db.create_index(f'{osm}.{state}_roads', ['geom'], 'gist')
+    db.create_index(f'{osm}.{state}_pois', ['geom'], 'gist')
+    db.create_index(f'{admin}.{state}_counties', ['countyfp'])
+    db.create_index(f'{admin}.{state}_tracts', ['countyfp'])
+    db.create_index(f'{admin}.{state}_blocks', ['countyfp10'])
+    minutes = u.getTimeDiffInMinutes(t0)
+    print(f"...finished in {minutes} mins")
+
+    # Steps 00a-08 are collected in extract_steps, and run in order below (or concurrently, 
+    # if parallel_extract). Each step only needs the state-wide tables, and the county 
+    # tables from the steps listed for it in extract_deps.
+    extract_steps = {}
+    if subdivide_geoms:
+        county_subdiv = f"{ssl}.{county_name}_county_subdiv"
+        extract_steps['00a'] = ("00a - Subdivide county outline", 
+            subdivide_sql(f"{admin}.{state}_counties", county_subdiv, 'countyfp', f"countyfp = '{county_code}'"))
+        # Same as st_intersects(geom, county geom)
+        def in_county(alias):
+            return f"exists (select 1 from {county_subdiv} s where st_intersects({alias}.geom, s.geom))"
+
     desc = "01 - Clip state-wide roads to county"
-    qry_text = f"""
+    if subdivide_geoms:
+        qry_text = f"""
+        drop table if exists {ssl}.{county_name}_roads;
+        create table {ssl}.{county_name}_roads as
+        select a.* from {osm}.{state}_roads a
+        where {in_county('a')};"""
+    else:
+        qry_text = f"""
         drop table if exists {ssl}.{county_name}_roads;
         create table {ssl}.{county_name}_roads as
         select a.* from {osm}.{state}_roads  a, 
@@ -64,7 +254,7 @@ def run_module(db, state, county_name, county_code, op_path, srid, ssl, fssl, st
             ) as b 
         where
         st_intersects(a.geom,b.geom);"""
-    u.run_query(desc, db, qry_text)
+    extract_steps['01'] = (desc, qry_text)
     
     desc = "02 - Extract county-specific shape into file"
     qry_text = f"""
@@ -72,7 +262,7 @@ def run_module(db, state, county_name, county_code, op_path, srid, ssl, fssl, st
         create table {ssl}.{county_name}_county as 
         select * from {admin}.{state}_counties
         where countyfp = '{county_code}';"""
-    u.run_query(desc, db, qry_text)
+    extract_steps['02'] = (desc, qry_text)
 
     # Note from DK: This is used to create the geojson used on the website for indicator data
     desc = "03 - Extract county-specific tracts into file"
@@ -81,60 +271,47 @@ def run_module(db, state, county_name, county_code, op_path, srid, ssl, fssl, st
         create table {ssl}.{county_name}_tracts as 
         select * from {admin}.{state}_tracts 
         where countyfp = '{county_code}';"""
-    u.run_query(desc, db, qry_text)
+    extract_steps['03'] = (desc, qry_text)
     
         # Note from DK:
     # POIs are used to help identify suitable sites
     # This table of all the POIS - use it for error checking and such in QGIS - not used in actual modeling 
     desc = "04 - Extract OSM POIs for the county"
-    qry_text = f"""
+    if subdivide_geoms:
+        qry_text = f"""
+        drop table if exists {ssl}.{county_name}_pois;
+        create table {ssl}.{county_name}_pois as 
+        select a.* from {osm}.{state}_pois a
+        where {in_county('a')}
+    """
+    else:
+        qry_text = f"""
         drop table if exists {ssl}.{county_name}_pois;
         create table {ssl}.{county_name}_pois as 
         select a.* from {osm}.{state}_pois a, {ssl}.{county_name}_county b
         where st_intersects(a.geom, b.geom)
     """
-    u.run_query(desc, db, qry_text)
+    extract_steps['04'] = (desc, qry_text)
     
     desc = "05 - Create government POIs"
     qry_text = f"""
         drop table if exists {ssl}.{county_name}_pois_gov;
         create table {ssl}.{county_name}_pois_gov as
         select * from {ssl}.{county_name}_pois 
-		where fclass in (
-			'post_office',
-			'fire_station',
-			'library',
-			'town_hall',
-			'police',
-			'public_building',
-			'courthouse',
-			'embassy') 
+		where fclass in ({sql_list(gov_poi_classes)}) 
         and (name not like '%(historical%)' or name is null)    
     """
-    u.run_query(desc, db, qry_text)
+    extract_steps['05'] = (desc, qry_text)
     
     desc = "06 - Create miscellaneous POIs"
     qry_text = f"""
         drop table if exists {ssl}.{county_name}_pois_misc;
         create table {ssl}.{county_name}_pois_misc as
         select * from {ssl}.{county_name}_pois 
-		where fclass in (
-            'school',
-            'hospital',
-            'kindergarten',
-            'community_centre',
-            'arts_centre',
-            'college',
-            'university',
-            'mall',
-            'nursing_home',
-            'supermarket',
-             'hostel',
-             'motel',
-             'cafe') 
+		where fclass in ({sql_list(misc_poi_classes)}) 
         and (name not like '%(historical%)' or name is null)    
     """
-    u.run_query(desc, db, qry_text)
+    extract_steps['06'] = (desc, qry_text)
     
     # Note from DK: We use this in the modeling work. These blocks will be clustered 
     # and used as origins for the Facility Location Model
@@ -144,7 +321,7 @@ def run_module(db, state, county_name, county_code, op_path, srid, ssl, fssl, st
         create table {ssl}.{county_name}_blocks as 
         select * from {admin}.{state}_blocks
         where countyfp10 = '{county_code}';"""
-    u.run_query(desc, db, qry_text)
+    extract_steps['07'] = (desc, qry_text)
     
     # Note from DK: Thes may not be necessary any longer - but keeping it just in case 
     # Removed housing10 for GIN processing (unsure if used, and how to obtain this data)
@@ -155,65 +332,42 @@ def run_module(db, state, county_name, county_code, op_path, srid, ssl, fssl, st
         select gid, countyfp10, tractce10, blockce, blockid10, 
             pop10, st_centroid(geom) geom 
             from {ssl}.{county_name}_blocks"""
-    u.run_query(desc, db, qry_text)
+    extract_steps['08'] = (desc, qry_text)
+
+    extract_deps = {
+        '01': ['00a'] if subdivide_geoms else [],
+        '04': ['00a'] if subdivide_geoms else ['02'],
+        '05': ['04'],
+        '06': ['04'],
+        '08': ['07'],
+        }
+    if parallel_extract:
+        # Each step is committed on its own connection
+        u.run_queries_parallel(db, extract_steps, extract_deps, parallel_workers)
+    else:
+        with steps_transaction(db):
+            for step_desc, step_qry in extract_steps.values():
+                u.run_query(step_desc, db, step_qry)
+
+    desc = "08a - Index and analyze county tables"
+    print(f"{u.getTimeNowStr()} Run query: {desc}")
+    t0 = time.time()
+    for table in ['roads','county','tracts','pois','pois_gov','pois_misc','blocks','block_centroids']:
+        db.create_index(f'{ssl}.{county_name}_{table}', ['geom'], 'gist')
+        db.analyze(f'{ssl}.{county_name}_{table}')
+    db.create_index(f'{ssl}.{county_name}_roads', ['gid'])
+    db.create_index(f'{ssl}.{county_name}_blocks', ['countyfp10'])
+    minutes = u.getTimeDiffInMinutes(t0)
+    print(f"...finished in {minutes} mins")
 
     # Note from DK:
     # https://gis.stackexchange.com/questions/16374/creating-regular-polygon-grid-in-postgis/16390#16390
-    # 
-    # This function is re-created for each county and state, in case SRID changes
-    desc = "09 - Create grid-creation function"
-    qry_text = f"""
-    CREATE OR REPLACE FUNCTION public.makegrid_2d (
-      bound_polygon public.geometry,
-      grid_step integer,
-      metric_srid integer = {state_srid} --metric SRID 
-    )
-    RETURNS public.geometry AS
-    $body$
-    DECLARE
-      BoundM public.geometry; --Bound polygon transformed to the metric projection (with metric_srid SRID)
-      Xmin DOUBLE PRECISION;
-      Xmax DOUBLE PRECISION;
-      Ymax DOUBLE PRECISION;
-      X DOUBLE PRECISION;
-      Y DOUBLE PRECISION;
-      sectors public.geometry[];
-      i INTEGER;
-    BEGIN
-      BoundM := ST_Transform($1, $3); --From WGS84 (SRID 4326) to the metric projection, to operate with step in meters
-      Xmin := ST_XMin(BoundM);
-      Xmax := ST_XMax(BoundM);
-      Ymax := ST_YMax(BoundM);
-
-      Y := ST_YMin(BoundM); --current sector's corner coordinate
-      i := -1;
-      <<yloop>>
-      LOOP
-        IF (Y > Ymax) THEN  --Better if generating polygons exceeds the bound for one step. You always can crop the result. But if not you may get not quite correct data for outbound polygons (e.g. if you calculate frequency per sector)
-            EXIT;
-        END IF;
-
-        X := Xmin;
-        <<xloop>>
-        LOOP
-          IF (X > Xmax) THEN
-              EXIT;
-          END IF;
-
-          i := i + 1;
-          sectors[i] := ST_GeomFromText('POLYGON(('||X||' '||Y||', '||(X+$2)||' '||Y||', '||(X+$2)||' '||(Y+$2)||', '||X||' '||(Y+$2)||', '||X||' '||Y||'))', $3);
-
-          X := X + $2;
-        END LOOP xloop;
-        Y := Y + $2;
-      END LOOP yloop;
-
-      RETURN ST_Transform(ST_Collect(sectors), ST_SRID($1));
-    END;
-    $body$
-    LANGUAGE 'plpgsql';    
-    """
-    u.run_query(desc, db, qry_text)
+    #
+    # Steps 09-11 originally created a PL/pgSQL function (makegrid_2d) that built each cell
+    # as WKT in nested loops and returned one ST_Collect geometry for step 11 to ST_Dump, 
+    # after pulling the county envelope into python in step 10. The grid is now generated 
+    # set-based in step 11, with the same cells (same origin, step and extent).
+    desc = "09-10 - ... nothing! Grid is generated set-based in step 11."
 
     # Note from DK: 
     # We create a grid over the county and use that as our potential "siting unit". 
@@ -223,303 +377,527 @@ def run_module(db, state, county_name, county_code, op_path, srid, ssl, fssl, st
     # * or you are creating a new grid for a different county
     # If you are changing the size you should change the name of the file in the sql text below. 
     #
-    # Envelope is the bounding box around the entire county      
-    desc = "10 - Create 0.5 mile grid - get envelope"
-    print(f"{u.getTimeNowStr()} Run query: {desc}")
-    t0 = time.time()    
-    qry_text = f"""
-        select st_astext(st_envelope(geom)) 
-        from {ssl}.{county_name}_county"""
-    qry_results = db.qry(qry_text)
-    get_county_envelope = qry_results.fetchall()[0][0]
-    minutes = u.getTimeDiffInMinutes(t0)
-    print(f"...finished in {minutes} mins")
-
-    # 'srid' below used for envelope, since that was created from county file, in 'srid'
-    # make2grid_2d uses 'state_srid' by default, as 3rd parameter (same results if 
-    # state_srid were to be passed below)
+    # Envelope is the bounding box around the entire county, transformed to the metric 
+    # state_srid so the cell step is in meters. Cells start at the envelope's min X/Y, and
+    # cover it (the last row/column can extend beyond it), then are transformed back to srid.
+    # Each cell gets its grid row/column, and an integer id derived from them.
     desc = "11 - Create 0.5 mile grid - generate grid file (entire bounding box of each county)"
-    print(f"{u.getTimeNowStr()} Run query: {desc}")
-    t0 = time.time()
-    qry_text = f"""
-        drop table if exists {ssl}.{county_name}_grid_p05miles ;
-        create table {ssl}.{county_name}_grid_p05miles as
-        SELECT cell FROM 
-            (SELECT (
-            ST_Dump(makegrid_2d(
-                        ST_GeomFromText('{get_county_envelope}', {srid}), -- WGS84 SRID for binding geom
-                        {mts_in_pt05mile}) -- cell step in meters for half mile
-        )).geom AS cell) AS q_grid    
-    """
-    db.qry(qry_text) # Not using run_query() to avoid issues with passing get_county_envelope
-    minutes = u.getTimeDiffInMinutes(t0)    
-    print(f"...finished in {minutes} mins")
+    with steps_transaction(db):
+        qry_text = f"""
+            drop table if exists {ssl}.{county_name}_grid_p05miles ;
+            create {scratch()} table {ssl}.{county_name}_grid_p05miles as
+            with bounds as (
+                select st_transform(st_envelope(geom), {state_srid}) geom_m
+                from {ssl}.{county_name}_county
+            ), 
+            dims as (
+                select st_xmin(geom_m) xmin, st_ymin(geom_m) ymin,
+                    floor((st_xmax(geom_m) - st_xmin(geom_m)) / {mts_in_pt05mile})::int + 1 num_cols,
+                    floor((st_ymax(geom_m) - st_ymin(geom_m)) / {mts_in_pt05mile})::int + 1 num_rows
+                from bounds
+            )
+            select r.row_idx, c.col_idx, 
+                r.row_idx * d.num_cols + c.col_idx + 1 cell_id,
+                st_transform(st_makeenvelope(
+                    d.xmin + c.col_idx * {mts_in_pt05mile}, 
+                    d.ymin + r.row_idx * {mts_in_pt05mile}, 
+                    d.xmin + (c.col_idx + 1) * {mts_in_pt05mile}, 
+                    d.ymin + (r.row_idx + 1) * {mts_in_pt05mile}, 
+                    {state_srid}), {srid}) cell
+            from dims d
+                cross join lateral generate_series(0, d.num_rows - 1) as r(row_idx)
+                cross join lateral generate_series(0, d.num_cols - 1) as c(col_idx);
+            create index on {ssl}.{county_name}_grid_p05miles using gist(cell);
+            analyze {ssl}.{county_name}_grid_p05miles;
+        """
+        u.run_query(desc, db, qry_text)
 
-    desc = "12 - Select grid cells that intersect county boundary"
-    qry_text = f"""
-        drop table if exists {ssl}.{county_name}_grid;
-        create table {ssl}.{county_name}_grid as
-        select a.cell geom, st_area(a.cell) md_area 
-        from {ssl}.{county_name}_grid_p05miles  a, 
-            {ssl}.{county_name}_county b where
-        st_intersects(a.cell,b.geom);    
-    """
-    u.run_query(desc, db, qry_text)
+        # idnum is the cell_id from step 11, i.e. derived from the cell's row/column in the grid, 
+        # so it is stable across re-runs with the same county and cell size (per DK's note above)
+        desc = "12 - Select grid cells that intersect county boundary"
+        if subdivide_geoms:
+            county_filter = f"exists (select 1 from {county_subdiv} s where st_intersects(a.cell, s.geom))"
+        else:
+            county_filter = f"exists (select 1 from {ssl}.{county_name}_county b where st_intersects(a.cell, b.geom))"
+        qry_text = f"""
+            drop table if exists {ssl}.{county_name}_grid;
+            create table {ssl}.{county_name}_grid as
+            select a.cell geom, st_area(a.cell) md_area, a.cell_id idnum 
+            from {ssl}.{county_name}_grid_p05miles  a 
+            where {county_filter}
+            order by a.cell_id;
+            alter table {ssl}.{county_name}_grid add primary key (idnum);
+            create index on {ssl}.{county_name}_grid using gist(geom);
+            analyze {ssl}.{county_name}_grid;
+        """
+        u.run_query(desc, db, qry_text)
 
-    #Note: This might run for a while
-    desc = "13 - Add unique ID to grid"
-    qry_text = f"""
-        alter table {ssl}.{county_name}_grid add column idnum int;
-        update {ssl}.{county_name}_grid c
-            set idnum = c2.seqnum
-            from (select c2.*, row_number() over () as seqnum
-                  from {ssl}.{county_name}_grid c2
-                 ) c2
-            where c2.geom = c.geom;    
-    """
-    u.run_query(desc, db, qry_text)
+    desc = "13 - ... nothing! Unique ID (idnum) is now assigned to grid in step 12."
 
     # This creates a road layer split by grid boundaries
     desc = "14 - Create roads that intersect grids, add grid_id to each road segment"
     print(f"{u.getTimeNowStr()} Run query: {desc}")
     t0 = time.time()
-    # ... name of road/grid intersection file
-    grid_intx = f"{county_name}_grid_intx"
-    # ... delete if it exists
-    qry_text = f"""drop table if exists {ssl}.{grid_intx};"""
-    db.qry(qry_text)
-    # ...run intersection to get both id fields into new roads file
-    db.intersect(
-        f'{ssl}.{grid_intx}', # op
-        f'{ssl}.{county_name}_grid','idnum','grid_id',
-        f'{ssl}.{county_name}_roads','gid','road_id'
-    ) 
-    minutes = u.getTimeDiffInMinutes(t0)
-    print(f"...finished in {minutes} mins")
+    with steps_transaction(db):
+        # ... name of road/grid intersection file
+        grid_intx = f"{county_name}_grid_intx"
+        # ... delete if it exists
+        qry_text = f"""drop table if exists {ssl}.{grid_intx};"""
+        db.qry(qry_text)
+        # ...run intersection to get both id fields into new roads file
+        if subdivide_geoms:
+            # Same output as db.intersect, with grid/road pairs found from the subdivided roads
+            create_subdivided(db, "14a - Subdivide roads", f"{ssl}.{county_name}_roads", 
+                              f"{ssl}.{county_name}_roads_subdiv", 'gid')
+            qry_text = f"""
+                create {scratch()} table {ssl}.{grid_intx} as
+                select a.idnum grid_id_gid, b.gid road_id_gid,
+                    case when st_within(a.geom, b.geom) then a.geom
+                        else st_multi(st_intersection(a.geom, b.geom)) end geom
+                from (
+                    select distinct g.idnum, r.gid 
+                    from {ssl}.{county_name}_grid g
+                        join {ssl}.{county_name}_roads_subdiv r on st_intersects(g.geom, r.geom)
+                    ) as p
+                    join {ssl}.{county_name}_grid a on a.idnum = p.idnum
+                    join {ssl}.{county_name}_roads b on b.gid = p.gid;
+            """
+            db.qry(qry_text)
+            db.create_index(f'{ssl}.{grid_intx}', ['grid_id_gid'])
+            db.create_index(f'{ssl}.{grid_intx}', ['road_id_gid'])
+            db.analyze(f'{ssl}.{grid_intx}')
+        else:
+            db.intersect(
+                f'{ssl}.{grid_intx}', # op
+                f'{ssl}.{county_name}_grid','idnum','grid_id',
+                f'{ssl}.{county_name}_roads','gid','road_id',
+                unlogged=unlogged_mode
+            ) 
+        minutes = u.getTimeDiffInMinutes(t0)
+        print(f"...finished in {minutes} mins")
 
-    # This adds some road attributes to clipped road file, which are used in step 23 below
-    desc = "15 - Copy fclass and name cols from original clipped roads file to new roads file"
-    t0 = time.time()    
-    print(f"{u.getTimeNowStr()} Run query: {desc}...")
-    for col in ['fclass','name']:
-        try:
-            db.add_column(ssl,grid_intx,col,'character varying')
-            db.column_copy(ssl,grid_intx,col,'road_id_gid',ssl,f'{county_name}_roads',col,'gid')
-        except:
-            print("... column copy failed!!") # This needs to go after next print
-            continue
+        # This adds some road attributes to clipped road file, which are used in step 23 below
+        desc = "15 - Copy fclass and name cols from original clipped roads file to new roads file"
+        t0 = time.time()    
+        print(f"{u.getTimeNowStr()} Run query: {desc}...")
+        for col in ['fclass','name']:
+            try:
+                db.add_column(ssl,grid_intx,col,'character varying')
+                db.column_copy(ssl,grid_intx,col,'road_id_gid',ssl,f'{county_name}_roads',col,'gid')
+            except:
+                if db.con.in_transaction():
+                    raise # The transaction is aborted, later statements in it would fail too
+                print("... column copy failed!!") # This needs to go after next print
+                continue
     minutes = u.getTimeDiffInMinutes(t0)
     print(f"...finished in {minutes} mins")
 
-    # This creates a subset of grid cells, that overlay the listed POIs
-    # Manually verified that the list of POIs here matches that above
-    desc = "16 - Attach all POI types to temporary grid"     
-    qry_text = f"""
-        drop table if exists {ssl}.{county_name}_temp_grid_voting_pois;
-        create table {ssl}.{county_name}_temp_grid_voting_pois as 
-        select a.*, 
-                st_area(a.geom) ,
-                b.fclass poi_class 
-            from 
-                {ssl}.{county_name}_grid a, 
-                    (select * from {ssl}.{county_name}_pois 
-                        where fclass in (
-                            'school',
-                            'post_office',
-                            'fire_station',
-                            'library',
-                            'hospital',
-                            'town_hall',
-                            'police',
-                            'public_building',
-                            'kindergarten',
-                            'community_centre',
-                            'arts_centre',
-                            'college',
-                            'courthouse',
-                            'university',
-                            'mall',
-                            'embassy',
-                            'nursing_home',
-                            'supermarket',
-                            'hostel',
-                            'motel',
-                            'cafe') 
-                        and (name not like '%(historical%)' or name is null)
-                    )  as b
-        where st_dwithin(a.geom,b.geom, .002)    
-    """
-    u.run_query(desc, db, qry_text)
+    # This counts the voting POIs near each grid cell, by POI class.
+    # The distance is in meters (state_srid), using the spatial index on the state-wide 
+    # voting POIs. Only POIs in the county are used, as in step 04.
+    with steps_transaction(db):
+        voting_pois = create_voting_pois(db, state, ssl, state_srid)
+        desc = "16 - Count voting POIs of each type near each grid cell"     
+        poi_county_table = county_subdiv if subdivide_geoms else f"{ssl}.{county_name}_county"
+        qry_text = f"""
+            drop table if exists {ssl}.{county_name}_temp_grid_voting_pois;
+            create {scratch()} table {ssl}.{county_name}_temp_grid_voting_pois as 
+            select a.idnum, 
+                array_agg(b.fclass) poi_classes,
+                {voting_poi_counts('b')}
+            from {ssl}.{county_name}_grid a
+                join {voting_pois} b 
+                    on st_dwithin(st_transform(a.geom, {state_srid}), b.geom_m, {voting_poi_distance_mts})
+            where exists (
+                select 1 from {poi_county_table} c where st_intersects(c.geom, b.geom)
+                )
+            group by a.idnum
+        """
+        u.run_query(desc, db, qry_text)
 
-    # This creates a county-wide grid (same as county_grid), with a column 
-    # added for POI classes from the cells in _temp_grid_voting_pois
-    desc = "17 - Attach the voting POIs to the working grid"
-    qry_text = f"""
-        drop table if exists {ssl}.{county_name}_grid_wdata;
-        create table {ssl}.{county_name}_grid_wdata as
-        select a.* , b.poi_classes 
-        from 
-            {ssl}.{county_name}_grid a 
-            left join 
-                (select idnum, array_agg(poi_class) poi_classes
-                from {ssl}.{county_name}_temp_grid_voting_pois 
-                group by idnum
-                ) as b
-            on a.idnum = b.idnum
-            order by idnum    
-    """
-    u.run_query(desc, db, qry_text)
+        # This creates a county-wide grid (same as county_grid), with columns 
+        # added for POI classes and counts from the cells in _temp_grid_voting_pois
+        desc = "17 - Attach the voting POIs to the working grid"
+        poi_count_cols = ", ".join(f"coalesce(b.num_{c}, 0) num_{c}" for c in voting_poi_classes)
+        qry_text = f"""
+            drop table if exists {ssl}.{county_name}_grid_wdata;
+            create table {ssl}.{county_name}_grid_wdata as
+            select a.* , b.poi_classes, {poi_count_cols}
+            from 
+                {ssl}.{county_name}_grid a 
+                left join {ssl}.{county_name}_temp_grid_voting_pois as b
+                on a.idnum = b.idnum
+                order by idnum    
+        """
+        u.run_query(desc, db, qry_text)
     
 
-    print("Steps 18-21 are to calculate proportional block population for each grid cell")
+    print("Steps 18-22 are to calculate proportional block population for each grid cell")
     # Note from DK: This isn't used too extensively - but we retain it anyways
-        
-    # This area is in Cartesian, in sq degrees
-    # Ok because it is used with intx area to get ratio for proportional population,
-    # and both areas are in the same unit
-    desc = "18 - Add area column to blocks, and calculate"
-    db.add_column(ssl,f'{county_name}_blocks','md_area','numeric')
-    qry_text = f"""
-        update {ssl}.{county_name}_blocks 
-        set md_area = st_area(geom);
-    """
-    u.run_query(desc, db, qry_text)
+    #
+    # Steps 18-22 used to add md_area to blocks, intersect blocks with the grid, then pull
+    # the intersections and the blocks table into pandas to compute proportional population,
+    # and write the results back to the database. This is now done in the database (step 22).
+    desc = "18-21 - ... nothing! Block population is allocated to grid cells in step 22."
+
+    # Blocks (b) and the grid cells (g) they intersect
+    with steps_transaction(db):
+        if subdivide_geoms:
+            create_subdivided(db, "21a - Subdivide blocks", f"{ssl}.{county_name}_blocks", 
+                              f"{ssl}.{county_name}_blocks_subdiv", 'gid')
+            blocks2grid_join = f"""from (
+                        select distinct s.gid, g.idnum
+                        from {ssl}.{county_name}_blocks_subdiv s
+                            join {ssl}.{county_name}_grid g on st_intersects(s.geom, g.geom)
+                        ) as p
+                        join {ssl}.{county_name}_blocks b on b.gid = p.gid
+                        join {ssl}.{county_name}_grid g on g.idnum = p.idnum"""
+        else:
+            blocks2grid_join = f"""from {ssl}.{county_name}_blocks b
+                        join {ssl}.{county_name}_grid g on st_intersects(b.geom, g.geom)"""
+
+        # Per-intersection and per-cell tables for debugging population calculations (optional)
+        # Same columns as the old pandas versions
+        if write_debug_tables:
+            desc = "21b - Write block/grid intersection debug tables"
+            qry_text = f"""
+                drop table if exists {ssl}.{county_name}_temp_intersection_df;
+                create table {ssl}.{county_name}_temp_intersection_df as
+                select *, 
+                    intx_area / nullif(md_area, 0) prop_area,
+                    intx_area / nullif(block_md_area, 0) block_prop_area,
+                    intx_area / nullif(block_md_area, 0) * pop10 block_prop_pop
+                from (
+                    select b.gid gid_gid, g.idnum grid_id_gid,
+                        st_area(case when st_within(b.geom, g.geom) then b.geom 
+                            else st_multi(st_intersection(b.geom, g.geom)) end) intx_area,
+                        g.md_area, b.gid, b.blockce, b.pop10, st_area(b.geom) block_md_area
+                    {blocks2grid_join}
+                    where b.countyfp10 = '{county_code}'
+                ) as intx;
+                drop table if exists {ssl}.{county_name}_table_grid_block_pop;
+                create table {ssl}.{county_name}_table_grid_block_pop as
+                select grid_id_gid, round(sum(block_prop_pop)) block_prop_pop, 
+                    array_agg(blockce) blockce, sum(pop10) pop10
+                from {ssl}.{county_name}_temp_intersection_df
+                group by grid_id_gid;
+            """
+            u.run_query(desc, db, qry_text)
+
+        # Intersect blocks with the grid (as db.intersect does, blocks within a cell are kept whole), 
+        # give each intersection its share of the block population by area ratio, and sum by cell. 
+        # Areas are in Cartesian, in sq degrees - Ok because only the ratio is used.
+        # grid_wdata is rebuilt with pop10 and block_prop_pop added to poi_classes from step 17;
+        # cells with no blocks get nulls, as before.
+        desc = "22 - Calculate proportional block population and add to working grid"
+        qry_text = f"""
+            drop table if exists {ssl}.{county_name}_grid_wdata_pop;
+            create table {ssl}.{county_name}_grid_wdata_pop as
+            with blocks2grid as (
+                select g.idnum grid_id_gid, b.pop10, st_area(b.geom) block_md_area,
+                    st_area(case when st_within(b.geom, g.geom) then b.geom 
+                        else st_multi(st_intersection(b.geom, g.geom)) end) intx_area
+                {blocks2grid_join}
+                where b.countyfp10 = '{county_code}'
+            ),
+            grid_block_pop as (
+                select grid_id_gid, sum(pop10) pop10,
+                    round(sum(intx_area / nullif(block_md_area, 0) * pop10)) block_prop_pop
+                from blocks2grid
+                group by grid_id_gid
+            )
+            select a.*, p.pop10::bigint pop10, p.block_prop_pop::bigint block_prop_pop
+            from {ssl}.{county_name}_grid_wdata a
+                left join grid_block_pop p on a.idnum = p.grid_id_gid
+            order by a.idnum;
+            drop table {ssl}.{county_name}_grid_wdata;
+            alter table {ssl}.{county_name}_grid_wdata_pop rename to {county_name}_grid_wdata;
+        """
+        u.run_query(desc, db, qry_text)
+        db.create_index(f'{ssl}.{county_name}_grid_wdata', ['idnum'])
+        db.analyze(f'{ssl}.{county_name}_grid_wdata')
+
+    # grid_wdata is saved as suitable_sites_raw when road length is added,
+    # and after dropping grids with certain road classes
+    # Note: Length is in degrees/cartesian, and used in the same unit in CCEP3
+    desc = "23 - Create raw suitable site layer"
+    with steps_transaction(db):
+        qry_text = f"""
+            drop table if exists {ssl}.{county_name}_suitable_sites_raw;
+            create table {ssl}.{county_name}_suitable_sites_raw as
+            select a.*, b.road_length from {ssl}.{county_name}_grid_wdata  a,  
+            	(
+            	select grid_id_gid idnum, sum(st_length(geom)) road_length
+            	from {ssl}.{county_name}_grid_intx 
+            	where fclass not in ('unclassified','bridleway','unknown','path') and fclass not like 'trac%'
+            	group by grid_id_gid 
+            	) as b
+            	where a.idnum = b.idnum;    
+        """
+        u.run_query(desc, db, qry_text)
+
+        desc = "24 - Count the POIs in each cell"
+        qry_text = f"""
+            alter table {ssl}.{county_name}_suitable_sites_raw   
+            add column num_poi integer;
+            update {ssl}.{county_name}_suitable_sites_raw  
+                set num_poi = cardinality(poi_classes);    
+        """
+        u.run_query(desc, db, qry_text)
+
+        desc = "25 - Create centroids from suitable site layers"
+        qry_text = f"""
+            drop table if exists {ssl}.{county_name}_suitable_sites_raw_centroid;
+            create table {ssl}.{county_name}_suitable_sites_raw_centroid as
+            select *, st_x(st_centroid(geom)) lon, st_y(st_centroid(geom)) lat 
+            from {ssl}.{county_name}_suitable_sites_raw;    
+        """
+        u.run_query(desc, db, qry_text)
     
-    desc = "19 - Create grids that intersect blocks, add block id to each grid"
-    # Note: This is the reverse of road and grid intersection in step 14
-    # In each blocks2grid polygon, 
-    #   gid_gid = gid (id) from blocks file
-    #   grid_id_gid = id from grid file
+    desc = "26 - Write centroids to output csv"
     print(f"{u.getTimeNowStr()} Run query: {desc}")
-    t0 = time.time()
-    # ... delete if it exists    
-    qry_text = f"""drop table if exists {ssl}.{county_name}_blocks2grid;"""
-    db.qry(qry_text)
-    db.intersect(
-        f'{ssl}.{county_name}_blocks2grid', # op
-        f'{ssl}.{county_name}_blocks','gid','gid',
-        f'{ssl}.{county_name}_grid','idnum','grid_id'
-    ) 
+    t0 = time.time()    
+    op_file = f'{op_path_ccep1}\{state}_{county_code}_suitable_site_raw_centroids.csv'
+    write_centroids_csv(db, ssl, f'{county_name}_suitable_sites_raw_centroid', op_file)
     minutes = u.getTimeDiffInMinutes(t0)
     print(f"...finished in {minutes} mins")
+    print(f"File written to {op_file}")
 
-    desc = "20 - Link the grid info to the intersection"
-    print(f"{u.getTimeNowStr()} Run query: {desc}")
-    t0 = time.time()
-    qry_text = f"""
-        select a.gid_gid, a.grid_id_gid, st_area(a.geom) intx_area, b.md_area
-        from {ssl}.{county_name}_blocks2grid a,
-            {ssl}.{county_name}_grid b
-        where 
-            a.grid_id_gid = b.idnum    
+def run_module(db, state, county_name, county_code, op_path, srid, ssl, fssl, state_srid, mts_in_pt05mile):
+    try:
+        create_suitable_sites(db, state, county_name, county_code, op_path, srid, ssl, fssl, 
+                              state_srid, mts_in_pt05mile)
+    finally:
+        # Also if a step failed, so scratch tables aren't left behind
+        if unlogged_mode:
+            try:
+                drop_scratch_tables(db, ssl, county_name)
+            except:
+                # Don't hide the error from the failed step
+                print("... dropping scratch tables failed")
+
+
+def run_statewide(db, state, counties, op_path, srid, ssl, fssl, state_srid, mts_in_pt05mile):
     """
-    qry_results = db.qry(qry_text)
-    minutes = u.getTimeDiffInMinutes(t0)
-    print(f"...finished in {minutes} mins")
+    Same output as run_module, for all counties of a state in one pass.
+    counties: dict of county name: county code
     
-    desc = "21 - Calculate the proportional population"
+    The statewide roads, POIs, and blocks are scanned once, and the grid, road/grid 
+    intersection, POIs and population are built for all counties together, in tables 
+    named {state}_statewide_* and tagged with sw_countyfp. The per-county tables 
+    used by later modules, and the suitable site csv, are then written from those.
+    Cells in the grid have the same idnum as in run_module.
+    """
+    osm = dv.osm
+    admin = dv.admin
+    op_path_ccep1 = f"{op_path}\CCEP1_Master_County_Suitable_Sites"
+    sw = f"{ssl}.{state}_statewide"
+    county_codes = sql_list(counties.values())
+
+    desc = "S00 - Index state-wide tables"
     print(f"{u.getTimeNowStr()} Run query: {desc}")
     t0 = time.time()
-    qry_text = f"""drop table if exists {ssl}.{county_name}_table_grid_block_pop;"""
-    db.qry(qry_text)
-
-    intersection_df= pd.DataFrame(qry_results.fetchall(), 
-                                  columns = ['gid_gid','grid_id_gid','intx_area','md_area'])
-    blocks = db.table2df(ssl,f'{county_name}_blocks')
-    # This filter shouldn't drop any values, because we're already working with county_specific blocks
-    blocks=blocks[blocks.countyfp10 == county_code]    
-    
-    # This value is a ratio of areas (of intx to grid), not an area itself. Doesn't appear to get used.
-    intersection_df['prop_area'] = intersection_df.intx_area / intersection_df.md_area
-    
-    blocks = blocks.rename(columns={'md_area':'block_md_area'})
-    # Join block values into this intersection df
-    intersection_df = intersection_df.merge(blocks[['gid','blockce','pop10','block_md_area']],
-                                            left_on='gid_gid', right_on='gid')
-    
-    # block_prop_area is a ratio of areas (of intx to block), and is used to 
-    # proportionately distribute the population of the block across the various grid intersections
-    intersection_df['block_md_area'] = intersection_df.block_md_area.astype('float')
-    intersection_df['block_prop_area']  = intersection_df.intx_area / intersection_df.block_md_area
-    # This is the population for each intersection polygon
-    intersection_df['block_prop_pop'] = intersection_df.block_prop_area * intersection_df.pop10
-
-    # temp file for debugging population calculations
-    qry_text = f"""drop table if exists {ssl}.{county_name}_temp_intersection_df;"""
-    db.qry(qry_text)
-    db.df2table(intersection_df, ssl,f'{county_name}_temp_intersection_df')
-    
-    grid_totals = intersection_df.groupby('grid_id_gid').agg({ 
-                                      'pop10':[sum],
-                                      'block_prop_pop':[sum],
-                                      'blockce':lambda x: tuple(x),
-                                     }).reset_index()
-    grid_totals = grid_totals.reset_index()
-    grid_totals.columns = grid_totals.columns.droplevel(1)
-    grid_totals = grid_totals[['grid_id_gid','block_prop_pop','blockce','pop10']]
-    grid_totals['block_prop_pop'] = np.round(grid_totals.block_prop_pop)
-    db.df2table(grid_totals, ssl,f'{county_name}_table_grid_block_pop')
-
+    db.create_index(f'{osm}.{state}_roads', ['geom'], 'gist')
+    db.create_index(f'{osm}.{state}_pois', ['geom'], 'gist')
+    db.create_index(f'{admin}.{state}_counties', ['countyfp'])
+    db.create_index(f'{admin}.{state}_tracts', ['countyfp'])
+    db.create_index(f'{admin}.{state}_blocks', ['countyfp10'])
+    db.create_index(f'{admin}.{state}_blocks', ['geom'], 'gist')
     minutes = u.getTimeDiffInMinutes(t0)
     print(f"...finished in {minutes} mins")
 
-    #Originally, grid_wdata had poi_classes. Here, pop10 and block_prop_pop are added
-    desc = "22 - Update working grid table with data"
-    print(f"{u.getTimeNowStr()} Run query: {desc}")
-    t0 = time.time()    
-    working_table_name = f'{county_name}_table_grid_block_pop'
-    destination_table_name = f'{county_name}_grid_wdata'
-    db.add_column(ssl,destination_table_name,'pop10','bigint')
-    db.add_column(ssl,destination_table_name,'block_prop_pop','bigint')
-    db.column_copy(ssl,destination_table_name,'pop10','idnum',ssl,working_table_name,'pop10','grid_id_gid')
-    db.column_copy(ssl,destination_table_name,'block_prop_pop','idnum',ssl,working_table_name,'block_prop_pop','grid_id_gid')
-    minutes = u.getTimeDiffInMinutes(t0)
-    print(f"...finished in {minutes} mins")  
+    desc = "S01 - Extract the counties to process"
+    qry_text = f"""
+        drop table if exists {sw}_counties;
+        create table {sw}_counties as 
+        select * from {admin}.{state}_counties
+        where countyfp in ({county_codes});
+        create index on {sw}_counties using gist(geom);
+        analyze {sw}_counties;
+    """
+    u.run_query(desc, db, qry_text)
 
-    # grid_wdata is saved as suitable_sites_raw when road length is added,
-    # and after dropping grids with certain road classes
-    # Note: Length is in degrees/cartesian, and used in the same unit in CCEP3
-    desc = "23 - Create raw suitable site layer"
+    # A road or POI on a county boundary is kept for each county it intersects, as in run_module
+    desc = "S02 - Clip state-wide roads and POIs to the counties"
+    qry_text = f"""
+        drop table if exists {sw}_roads;
+        create table {sw}_roads as
+        select b.countyfp sw_countyfp, a.* 
+        from {osm}.{state}_roads a
+            join {sw}_counties b on st_intersects(a.geom, b.geom);
+        create index on {sw}_roads using gist(geom);
+        create index on {sw}_roads (sw_countyfp, gid);
+        analyze {sw}_roads;
+        
+        drop table if exists {sw}_pois;
+        create table {sw}_pois as
+        select b.countyfp sw_countyfp, a.* 
+        from {osm}.{state}_pois a
+            join {sw}_counties b on st_intersects(a.geom, b.geom);
+        create index on {sw}_pois using gist(geom);
+        create index on {sw}_pois (sw_countyfp);
+        analyze {sw}_pois;
+    """
+    u.run_query(desc, db, qry_text)
+
+    # Same grid as run_module steps 11-12, with the cell origin at each county's envelope
+    desc = "S03 - Create 0.5 mile grid for each county"
     qry_text = f"""
-        drop table if exists {ssl}.{county_name}_suitable_sites_raw;
-        create table {ssl}.{county_name}_suitable_sites_raw as
-        select a.*, b.road_length from {ssl}.{county_name}_grid_wdata  a,  
-        	(
-        	select grid_id_gid idnum, sum(st_length(geom)) road_length
-        	from {ssl}.{county_name}_grid_intx 
-        	where fclass not in ('unclassified','bridleway','unknown','path') and fclass not like 'trac%'
-        	group by grid_id_gid 
-        	) as b
-        	where a.idnum = b.idnum;    
+        drop table if exists {sw}_grid;
+        create table {sw}_grid as
+        with dims as (
+            select countyfp, st_xmin(geom_m) xmin, st_ymin(geom_m) ymin,
+                floor((st_xmax(geom_m) - st_xmin(geom_m)) / {mts_in_pt05mile})::int + 1 num_cols,
+                floor((st_ymax(geom_m) - st_ymin(geom_m)) / {mts_in_pt05mile})::int + 1 num_rows
+            from (
+                select countyfp, st_transform(st_envelope(geom), {state_srid}) geom_m
+                from {sw}_counties
+            ) as bounds
+        ),
+        cells as (
+            select d.countyfp, 
+                r.row_idx * d.num_cols + c.col_idx + 1 cell_id,
+                st_transform(st_makeenvelope(
+                    d.xmin + c.col_idx * {mts_in_pt05mile}, 
+                    d.ymin + r.row_idx * {mts_in_pt05mile}, 
+                    d.xmin + (c.col_idx + 1) * {mts_in_pt05mile}, 
+                    d.ymin + (r.row_idx + 1) * {mts_in_pt05mile}, 
+                    {state_srid}), {srid}) cell
+            from dims d
+                cross join lateral generate_series(0, d.num_rows - 1) as r(row_idx)
+                cross join lateral generate_series(0, d.num_cols - 1) as c(col_idx)
+        )
+        select a.countyfp sw_countyfp, a.cell geom, st_area(a.cell) md_area, a.cell_id idnum
+        from cells a
+            join {sw}_counties b on a.countyfp = b.countyfp and st_intersects(a.cell, b.geom)
+        order by a.countyfp, a.cell_id;
+        alter table {sw}_grid add primary key (sw_countyfp, idnum);
+        create index on {sw}_grid using gist(geom);
+        analyze {sw}_grid;
     """
     u.run_query(desc, db, qry_text)
 
-    desc = "24 - Count the POIs in each cell"
+    desc = "S04 - Create roads that intersect grids, with grid_id and road attributes"
     qry_text = f"""
-        alter table {ssl}.{county_name}_suitable_sites_raw   
-        add column num_poi integer;
-        update {ssl}.{county_name}_suitable_sites_raw  
-            set num_poi = cardinality(poi_classes);    
+        drop table if exists {sw}_grid_intx;
+        create table {sw}_grid_intx as
+        select a.sw_countyfp, a.idnum grid_id_gid, b.gid road_id_gid,
+            case when st_within(a.geom, b.geom) then a.geom
+                else st_multi(st_intersection(a.geom, b.geom)) end geom,
+            b.fclass, b.name
+        from {sw}_grid a
+            join {sw}_roads b on a.sw_countyfp = b.sw_countyfp and st_intersects(a.geom, b.geom);
+        create index on {sw}_grid_intx (sw_countyfp, grid_id_gid);
+        analyze {sw}_grid_intx;
     """
     u.run_query(desc, db, qry_text)
 
-    desc = "25 - Create centroids from suitable site layers"
+    # Same as run_module steps 16-22: voting POIs near each cell (and their counts), 
+    # and block population allocated to cells by area ratio
+    voting_pois = create_voting_pois(db, state, ssl, state_srid)
+    poi_count_cols = ", ".join(f"coalesce(b.num_{c}, 0) num_{c}" for c in voting_poi_classes)
+    desc = "S05 - Attach voting POIs and block population to the working grid"
     qry_text = f"""
-        drop table if exists {ssl}.{county_name}_suitable_sites_raw_centroid;
-        create table {ssl}.{county_name}_suitable_sites_raw_centroid as
-        select *, st_x(st_centroid(geom)) lon, st_y(st_centroid(geom)) lat 
-        from {ssl}.{county_name}_suitable_sites_raw;    
+        drop table if exists {sw}_grid_wdata;
+        create table {sw}_grid_wdata as
+        with grid_pois as (
+            select a.sw_countyfp, a.idnum, array_agg(b.fclass) poi_classes,
+                {voting_poi_counts('b')}
+            from {sw}_grid a
+                join {voting_pois} b 
+                    on st_dwithin(st_transform(a.geom, {state_srid}), b.geom_m, {voting_poi_distance_mts})
+            where exists (
+                select 1 from {sw}_counties c 
+                where c.countyfp = a.sw_countyfp and st_intersects(c.geom, b.geom)
+                )
+            group by a.sw_countyfp, a.idnum
+        ),
+        blocks2grid as (
+            select g.sw_countyfp, g.idnum grid_id_gid, b.pop10, st_area(b.geom) block_md_area,
+                st_area(case when st_within(b.geom, g.geom) then b.geom 
+                    else st_multi(st_intersection(b.geom, g.geom)) end) intx_area
+            from {admin}.{state}_blocks b
+                join {sw}_grid g on b.countyfp10 = g.sw_countyfp and st_intersects(b.geom, g.geom)
+            where b.countyfp10 in ({county_codes})
+        ),
+        grid_block_pop as (
+            select sw_countyfp, grid_id_gid, sum(pop10) pop10,
+                round(sum(intx_area / nullif(block_md_area, 0) * pop10)) block_prop_pop
+            from blocks2grid
+            group by sw_countyfp, grid_id_gid
+        )
+        select a.*, b.poi_classes, {poi_count_cols}, 
+            p.pop10::bigint pop10, p.block_prop_pop::bigint block_prop_pop
+        from {sw}_grid a
+            left join grid_pois b on a.sw_countyfp = b.sw_countyfp and a.idnum = b.idnum
+            left join grid_block_pop p on a.sw_countyfp = p.sw_countyfp and a.idnum = p.grid_id_gid
+        order by a.sw_countyfp, a.idnum;
+        create index on {sw}_grid_wdata (sw_countyfp, idnum);
+        analyze {sw}_grid_wdata;
     """
     u.run_query(desc, db, qry_text)
-    
-    desc = "26 - Write centroids to output csv"
-    print(f"{u.getTimeNowStr()} Run query: {desc}")
-    t0 = time.time()    
-    df_label = f'{county_name}_suitable_sites_raw_centroid'
-    temp_df = db.table2df(ssl,df_label)
-    temp_df = temp_df.drop('geom',axis=1)
-    op_file = f'{op_path_ccep1}\{state}_{county_code}_suitable_site_raw_centroids.csv'
-    temp_df.to_csv(op_file,index=False)
-    minutes = u.getTimeDiffInMinutes(t0)
-    print(f"...finished in {minutes} mins")
-    print(f"File written to {op_file}")
+
+    # Same as run_module steps 23-25
+    desc = "S06 - Create raw suitable site centroids"
+    qry_text = f"""
+        drop table if exists {sw}_suitable_sites_raw_centroid;
+        create table {sw}_suitable_sites_raw_centroid as
+        select a.*, b.road_length, cardinality(a.poi_classes) num_poi,
+            st_x(st_centroid(a.geom)) lon, st_y(st_centroid(a.geom)) lat
+        from {sw}_grid_wdata a,
+            (
+            select sw_countyfp, grid_id_gid idnum, sum(st_length(geom)) road_length
+            from {sw}_grid_intx
+            where fclass not in ('unclassified','bridleway','unknown','path') and fclass not like 'trac%'
+            group by sw_countyfp, grid_id_gid
+            ) as b
+        where a.sw_countyfp = b.sw_countyfp and a.idnum = b.idnum
+        order by a.sw_countyfp, a.idnum;
+        create index on {sw}_suitable_sites_raw_centroid (sw_countyfp);
+        analyze {sw}_suitable_sites_raw_centroid;
+    """
+    u.run_query(desc, db, qry_text)
+
+    # The county, tracts and blocks tables have their own county code columns, 
+    # the rest are filtered on sw_countyfp, which is then dropped
+    sources = {
+        'county': (f'{admin}.{state}_counties', 'countyfp'),
+        'tracts': (f'{admin}.{state}_tracts', 'countyfp'),
+        'blocks': (f'{admin}.{state}_blocks', 'countyfp10'),
+        'pois': (f'{sw}_pois', 'sw_countyfp'),
+        'pois_gov': (f'{sw}_pois', 'sw_countyfp'),
+        'pois_misc': (f'{sw}_pois', 'sw_countyfp'),
+        'grid': (f'{sw}_grid', 'sw_countyfp'),
+        'grid_wdata': (f'{sw}_grid_wdata', 'sw_countyfp'),
+        'suitable_sites_raw_centroid': (f'{sw}_suitable_sites_raw_centroid', 'sw_countyfp'),
+        }
+    poi_filters = {
+        'pois_gov': gov_poi_classes,
+        'pois_misc': misc_poi_classes,
+        }
+    for county_name, county_code in counties.items():
+        desc = f"S07 - Write county tables and suitable site csv for {county_name}"
+        print(f"{u.getTimeNowStr()} Run query: {desc}")
+        t0 = time.time()
+        for table in statewide_county_tables:
+            source, code_col = sources[table]
+            where = f"{code_col} = '{county_code}'"
+            if table in poi_filters:
+                where += f""" and fclass in ({sql_list(poi_filters[table])})
+                    and (name not like '%(historical%)' or name is null)"""
+            qry_text = f"""
+                drop table if exists {ssl}.{county_name}_{table};
+                create table {ssl}.{county_name}_{table} as
+                select * from {source} where {where};
+            """
+            if code_col == 'sw_countyfp':
+                qry_text += f"""alter table {ssl}.{county_name}_{table} drop column sw_countyfp;"""
+            db.qry(qry_text)
+            db.create_index(f'{ssl}.{county_name}_{table}', ['geom'], 'gist')
+            db.analyze(f'{ssl}.{county_name}_{table}')
+
+        op_file = f'{op_path_ccep1}\{state}_{county_code}_suitable_site_raw_centroids.csv'
+        write_centroids_csv(db, ssl, f'{county_name}_suitable_sites_raw_centroid', op_file)
+        minutes = u.getTimeDiffInMinutes(t0)
+        print(f"...finished in {minutes} mins")
+        print(f"File written to {op_file}")
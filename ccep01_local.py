@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Wed Oct 21 09:12:37 2026
+
+@author: Gorgonio
+
+CCEP1 without a database: the same suitable site csv as ccep01.run_module, computed
+in memory with geopandas/shapely (STRtree), from local copies of the state layers.
+
+Useful for small counties, where the database round trips cost more than the geometry
+work, and for running CCEP1 on a machine without postgres.
+
+Inputs are read from CCEP1_Local_Inputs in ip_path, one file per state layer, named
+{state}_counties, {state}_blocks, {state}_roads, {state}_pois, as (geo)parquet or
+GeoPackage (.parquet is used if both exist). Columns are the same as in the database
+tables (countyfp, countyfp10, blockce, pop10, fclass, name, ...), in srid.
+
+Grid cells, idnums, road lengths, POI classes/counts and proportional population are
+computed as in ccep01 steps 11-25. The per-class POI counts (num_<class>) are not computed,
+since ccep01 only keeps them in the database, not in the csv.
+
+Needs shapely 2.0+ and geopandas 0.12+ (not the python 3.6 environment in the README).
+The spatial index is only queried with 'intersects', since 'dwithin' needs a newer geopandas
+built against GEOS 3.10+.
+"""
+
+import os
+import re
+import time
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+import ccep_utils as u
+import ccep01
+
+local_inputs_dir = "CCEP1_Local_Inputs"
+
+# Road classes not counted in road length (step 23), fclass starting with 'trac' is also excluded
+excluded_road_classes = ['unclassified','bridleway','unknown','path']
+
+# Same as sql: name like '%(historical%)'
+historical_name = re.compile(r"\(historical.*\)$", re.DOTALL)
+
+def read_layer(ip_path_local, state, layer, bbox=None):
+    """Read a state layer from parquet or GeoPackage. bbox (in srid) is used to only read nearby features from a GeoPackage"""
+    parquet_file = f"{ip_path_local}\{state}_{layer}.parquet"
+    gpkg_file = f"{ip_path_local}\{state}_{layer}.gpkg"
+    if os.path.exists(parquet_file):
+        return gpd.read_parquet(parquet_file)
+    elif os.path.exists(gpkg_file):
+        return gpd.read_file(gpkg_file, bbox=bbox)
+    else:
+        raise FileNotFoundError(f"No parquet or gpkg file found for {state}_{layer} in {ip_path_local}")
+
+def select_intersecting(gdf, geom):
+    """Features of gdf that intersect geom (st_intersects), using the spatial index"""
+    return gdf.iloc[np.sort(gdf.sindex.query(geom, predicate='intersects'))]
+
+def not_historical(names):
+    return ~names.fillna('').map(lambda name: historical_name.search(name) is not None)
+
+def make_grid(county_geom, srid, state_srid, mts_in_pt05mile):
+    """
+    Same as ccep01 steps 11-12: cells over the county envelope, in meters (state_srid),
+    with idnum from the cell's row/column, keeping the cells that intersect the county
+    """
+    step = float(mts_in_pt05mile)
+    envelope = gpd.GeoSeries([shapely.box(*county_geom.bounds)], crs=f"EPSG:{srid}")
+    xmin, ymin, xmax, ymax = envelope.to_crs(f"EPSG:{state_srid}").total_bounds
+    num_cols = int(np.floor((xmax - xmin) / step)) + 1
+    num_rows = int(np.floor((ymax - ymin) / step)) + 1
+    row_idx, col_idx = np.divmod(np.arange(num_rows * num_cols), num_cols)
+    cells = gpd.GeoSeries(
+        shapely.box(xmin + col_idx * step, ymin + row_idx * step,
+                    xmin + (col_idx + 1) * step, ymin + (row_idx + 1) * step),
+        crs=f"EPSG:{state_srid}").to_crs(f"EPSG:{srid}")
+    grid = gpd.GeoDataFrame({'idnum': row_idx * num_cols + col_idx + 1}, geometry=cells.values)
+    grid = select_intersecting(grid, county_geom).reset_index(drop=True)
+    grid.insert(0, 'md_area', shapely.area(grid.geometry.values))
+    return grid
+
+def intersect_with_grid(grid, gdf):
+    """
+    Pairs of (grid position, gdf position) that intersect, and their intersection geometry.
+    As in postgis_pandas.intersect, a geometry within a cell is kept whole.
+    """
+    gdf_pos, grid_pos = grid.sindex.query(gdf.geometry.values, predicate='intersects')
+    a = gdf.geometry.values[gdf_pos]
+    b = grid.geometry.values[grid_pos]
+    intx = np.where(shapely.within(a, b), a, shapely.intersection(a, b))
+    return grid_pos, gdf_pos, intx
+
+def run_module(state, county_name, county_code, op_path, srid, state_srid, mts_in_pt05mile, ip_path):
+    op_path_ccep1 = f"{op_path}\CCEP1_Master_County_Suitable_Sites"
+    ip_path_local = f"{ip_path}\{local_inputs_dir}"
+
+    desc = "01 - Read county, blocks, roads and POIs"
+    print(f"{u.getTimeNowStr()} Run: {desc}")
+    t0 = time.time()
+    counties = read_layer(ip_path_local, state, 'counties')
+    county_geom = shapely.union_all(counties[counties.countyfp == county_code].geometry.values)
+    bbox = county_geom.bounds
+    blocks = read_layer(ip_path_local, state, 'blocks', bbox)
+    blocks = blocks[blocks.countyfp10 == county_code].reset_index(drop=True)
+    roads = select_intersecting(read_layer(ip_path_local, state, 'roads', bbox), county_geom)
+    pois = select_intersecting(read_layer(ip_path_local, state, 'pois', bbox), county_geom)
+    voting_pois = pois[pois.fclass.isin(ccep01.voting_poi_classes) & not_historical(pois.name)]
+    minutes = u.getTimeDiffInMinutes(t0)
+    print(f"...finished in {minutes} mins")
+
+    desc = "11-12 - Create 0.5 mile grid over the county"
+    print(f"{u.getTimeNowStr()} Run: {desc}")
+    grid = make_grid(county_geom, srid, state_srid, mts_in_pt05mile)
+    print(f"... {len(grid)} grid cells")
+
+    # Road length is in degrees/cartesian, as in ccep01 (used in the same unit in CCEP3)
+    desc = "14-15 - Road length in each grid cell"
+    print(f"{u.getTimeNowStr()} Run: {desc}")
+    t0 = time.time()
+    fclass = roads.fclass
+    roads = roads[fclass.notnull() & ~fclass.isin(excluded_road_classes) &
+                  ~fclass.fillna('').str.startswith('trac')]
+    grid_pos, road_pos, intx = intersect_with_grid(grid, roads)
+    road_length = pd.Series(shapely.length(intx)).groupby(grid.idnum.values[grid_pos]).sum()
+    minutes = u.getTimeDiffInMinutes(t0)
+    print(f"...finished in {minutes} mins")
+
+    # Distance is in meters (state_srid), as in ccep01 step 16
+    desc = "16-17 - Voting POI classes near each grid cell"
+    print(f"{u.getTimeNowStr()} Run: {desc}")
+    t0 = time.time()
+    grid_m = grid.geometry.to_crs(f"EPSG:{state_srid}")
+    pois_m = voting_pois.geometry.to_crs(f"EPSG:{state_srid}")
+    # Candidates from the index with the cells buffered by the distance, then the exact 
+    # distance check (st_dwithin in ccep01), so the buffer's segment approximation doesn't matter
+    grid_pos, poi_pos = pois_m.sindex.query(grid_m.buffer(ccep01.voting_poi_distance_mts).values, 
+                                            predicate='intersects')
+    within = shapely.distance(grid_m.values[grid_pos], pois_m.values[poi_pos]) <= ccep01.voting_poi_distance_mts
+    grid_pos, poi_pos = grid_pos[within], poi_pos[within]
+    grid_pois = pd.DataFrame({'idnum': grid.idnum.values[grid_pos],
+                              'fclass': voting_pois.fclass.values[poi_pos]})
+    poi_classes = grid_pois.groupby('idnum').fclass.agg(list).rename('poi_classes')
+    minutes = u.getTimeDiffInMinutes(t0)
+    print(f"...finished in {minutes} mins")
+
+    # Areas are in sq degrees, as in ccep01 - Ok because only the ratio is used
+    desc = "18-22 - Proportional block population for each grid cell"
+    print(f"{u.getTimeNowStr()} Run: {desc}")
+    t0 = time.time()
+    grid_pos, block_pos, intx = intersect_with_grid(grid, blocks)
+    block_area = shapely.area(blocks.geometry.values)[block_pos]
+    block_pop = blocks.pop10.values[block_pos].astype('float')
+    with np.errstate(divide='ignore', invalid='ignore'):
+        block_prop_pop = np.where(block_area > 0, shapely.area(intx) / block_area, np.nan) * block_pop
+    grid_pop = pd.DataFrame({'idnum': grid.idnum.values[grid_pos], 'pop10': block_pop,
+                             'block_prop_pop': block_prop_pop}).groupby('idnum').sum(min_count=1)
+    # Round half to even, as postgres round() does for double precision in step 22
+    grid_pop = grid_pop.round().astype('Int64')
+    minutes = u.getTimeDiffInMinutes(t0)
+    print(f"...finished in {minutes} mins")
+
+    # Same columns as ccep01's suitable_sites_raw_centroid, without geom
+    desc = "23-26 - Write suitable site centroids to output csv"
+    print(f"{u.getTimeNowStr()} Run: {desc}")
+    sites = grid.join(poi_classes, on='idnum').join(grid_pop, on='idnum')
+    sites = sites.join(road_length.rename('road_length'), on='idnum', how='inner')
+    sites['num_poi'] = sites.poi_classes.map(len, na_action='ignore').astype('Int64')
+    # As in ccep01.write_centroids_csv: integer columns with missing values are written as floats (2.0)
+    for col in ['pop10', 'block_prop_pop', 'num_poi']:
+        sites[col] = sites[col].astype('float64') if sites[col].isna().any() else sites[col].astype('int64')
+    centroids = shapely.centroid(sites.geometry.values)
+    sites['lon'] = shapely.get_x(centroids)
+    sites['lat'] = shapely.get_y(centroids)
+    sites = pd.DataFrame(sites.drop(columns='geometry'))
+
+    op_file = f'{op_path_ccep1}\{state}_{county_code}_suitable_site_raw_centroids.csv'
+    sites.to_csv(op_file,index=False)
+    print(f"File written to {op_file}")
@@ -30,52 +30,215 @@ no established method for determining optimal number of clusters.
 
 """
 
+import os
+import time
+import shutil
 import pandas as pd
 import numpy as np
-from sklearn.externals import joblib
 import ccep_utils as u
 import ccep_datavars as dv
 
 
-def run_module(db, state, county_name, county_code, op_path, srid, ssl, fssl, ip_path, state_code, plot=False): 
+# Clustering method used in step 04
+# "kmeans" - original DK method. KMeans on block centroids in srid, unweighted, 
+#            with sklearn's default random restarts
+# "weighted" - MiniBatchKMeans on block centroids projected to state_srid (meters), 
+#            weighted by registered voters, so that cluster centers follow voters 
+#            rather than block counts. Seeded, so results are reproducible.
+cluster_mode = "kmeans"
+# Used with cluster_mode = "weighted"
+cluster_seed = 42
+cluster_batch_size = 4096
+# If True, k-means is initialized from the previous run's cluster centers (saved with the 
+# cluster file), e.g. when re-clustering after a registered voter data refresh. 
+# Cluster labels then stay stable, and most of the CCEP4 distance matrix can be re-used.
+cluster_warm_start = False
+
+# Written into the cache directory once the cache is complete. The parquet reader skips
+# files starting with _, so it isn't read as data.
+voter_cache_marker = "_SUCCESS"
+
+# Cache is rebuilt if it wasn't completed (no marker file, e.g. an interrupted build), 
+# or the state-wide voter csv is newer than the marker
+def voter_cache_is_stale(ip_regvoter_file, ip_regvoter_cache):
+    marker_file = f"{ip_regvoter_cache}\{voter_cache_marker}"
+    if not os.path.exists(marker_file):
+        return True
+    return os.path.getmtime(ip_regvoter_file) > os.path.getmtime(marker_file)
+
+# One-time conversion of the state-wide registered voter csv into a parquet dataset, 
+# partitioned by county, so each county run reads only its own rows.
+# GEOID and county are stored as int64, and the numeric voter columns as float64, which 
+# holds the voter counts exactly, so totals and k-means weights match a run from the csv
+def build_voter_cache(ip_regvoter_file, ip_regvoter_cache):
+    t0 = time.time()
+    print(f"{u.getTimeNowStr()} Converting {ip_regvoter_file} to county-partitioned parquet in {ip_regvoter_cache}")
+    voters = pd.read_csv(ip_regvoter_file)
+    # Drop any rows where GEOID, county, or R_totreg_r are NA
+    voters = voters.dropna(subset=['GEOID', 'county', 'R_totreg_r'])    
+    voters['GEOID'] = voters.GEOID.astype('int64')
+    voters['county'] = voters.county.astype('int64')
+    voter_cols = [c for c in voters.select_dtypes(include='number').columns if c not in ['GEOID', 'county']]
+    voters[voter_cols] = voters[voter_cols].astype('float64')
+    if os.path.isdir(ip_regvoter_cache):
+        shutil.rmtree(ip_regvoter_cache)
+    voters.to_parquet(ip_regvoter_cache, partition_cols=['county'], index=False)
+    # Only marked complete after all partitions are written
+    with open(f"{ip_regvoter_cache}\{voter_cache_marker}", 'w') as f:
+        f.write(u.getTimeNowStr())
+    minutes = u.getTimeDiffInMinutes(t0)
+    print(f"...finished in {minutes} mins")
+
+# Centers of the previous run, as an array for k-means init. None if they don't exist, 
+# or were computed in a different srid (i.e. with a different cluster_mode)
+def load_previous_centers(op_file_centers, cluster_srid):
+    if not os.path.exists(op_file_centers):
+        print("Warm start: no previous cluster centers found, clustering from random starts")
+        return None
+    centers = pd.read_parquet(op_file_centers).sort_values('cluster_labels')
+    if centers.srid.iloc[0] != str(cluster_srid):
+        print(f"Warm start: previous centers are in SRID {centers.srid.iloc[0]}, not {cluster_srid}. " + \
+              "Clustering from random starts")
+        return None
+    print(f"Warm start: initializing k-means from {len(centers)} previous cluster centers")
+    return centers[['X','Y']].values
+
+# Report how many blocks changed cluster since the previous run, and write out the 
+# clusters that changed (lost or gained blocks). CCEP4 only re-routes clusters whose 
+# centroid moves to a different road node, so most of the distance matrix is kept.
+def report_cluster_changes(previous, clusters, op_file_changes):
+    joined = clusters[['GEOID','cluster_labels']].merge(previous, on='GEOID', how='outer', 
+                                                        suffixes=('', '_previous'))
+    changed = joined[joined.cluster_labels != joined.cluster_labels_previous]
+    changed_clusters = set(changed.cluster_labels.dropna()) | set(changed.cluster_labels_previous.dropna())
+    changed_clusters = sorted(int(i) for i in changed_clusters)
+    print(f"Blocks that changed cluster since previous run: {len(changed)} of {len(joined)}")
+    print(f"Clusters that changed since previous run: {len(changed_clusters)} of {clusters.cluster_labels.nunique()}")
+    pd.DataFrame({'cluster_labels': changed_clusters}).to_csv(op_file_changes, index=False)
+
+# Write the full blocks + voters + clusters data to csv as well, for examining data and debugging
+write_debug_csv = False
+
+# Budget for the downstream cluster x site matrix (CCEP4 distance matrix, CCEP5 FLP model), 
+# as a number of cluster-site pairs. The number of clusters is capped so that 
+# clusters x expected scored sites fits. None for no cap (see README, CCEP2 matrix budget).
+# It is applied on top of the population thresholds below, i.e. it can only lower K.
+matrix_budget_cells = None
+# If True and there is a budget, stop when the number of scored sites can't be estimated
+# (no CCEP3 or CCEP1 output yet), instead of clustering with the population-based K only
+matrix_budget_required = False
+
+# Same CCEP1 site filters as CCEP3 step 05 (Q1, Q2 and Q4), without LKS/fixed sites 
+# and the LA min population, so this is close to the CCEP3 site count
+ccep3_poi_classes = ['fire_station', 'library', 'town_hall', 'public_building', 
+                     'school', 'community_centre', 'arts_centre', 'college', 'university']
+def estimate_scored_sites(ccep1_sites):
+    has_pop = ccep1_sites.block_prop_pop > 0
+    poi_classes = ccep1_sites.poi_classes.fillna('')
+    q1 = (ccep1_sites.road_length >= 0.07) & has_pop
+    q2 = (ccep1_sites.road_length >= 0.01) & ccep1_sites.poi_classes.notnull() & \
+         (ccep1_sites.num_poi > 1) & has_pop
+    q4 = poi_classes.map(lambda c: any(t in c for t in ccep3_poi_classes)) & has_pop
+    return int((q1 | q2 | q4).sum())
+
+# Expected number of scored sites for the county, for sizing the cluster x site matrix.
+# Uses the CCEP3 output if it exists from a prior run, otherwise CCEP1 suitable sites 
+# filtered as in CCEP3. None if neither exists.
+def expected_num_sites(op_path, state, county_code):
+    ccep3_file = f"{op_path}\CCEP3_Master_County_FLP_Files\{state}_{county_code}_all_sites_scored.csv"
+    ccep1_file = f"{op_path}\CCEP1_Master_County_Suitable_Sites\{state}_{county_code}_suitable_site_raw_centroids.csv"
+    if os.path.exists(ccep3_file):
+        with open(ccep3_file) as f:
+            num_sites = sum(1 for line in f) - 1 # Skip header
+        print(f"Expected number of scored sites = {num_sites}, from {ccep3_file}")
+        return num_sites
+    if os.path.exists(ccep1_file):
+        ccep1_sites = pd.read_csv(ccep1_file, usecols=['road_length','block_prop_pop','poi_classes','num_poi'])
+        num_sites = estimate_scored_sites(ccep1_sites)
+        print(f"Expected number of scored sites = {num_sites} (of {len(ccep1_sites)} suitable sites), " + \
+              f"using CCEP3 filters on {ccep1_file}")
+        return num_sites
+    return None
+
+# True if K clusters x num_sites fit the budget (or there is no budget to check against)
+def fits_matrix_budget(K, num_sites):
+    if matrix_budget_cells is None or num_sites is None:
+        return True
+    return K <= matrix_budget_cells // max(num_sites, 1)
+
+# Return the largest number of clusters, up to K, for which the cluster x site matrix 
+# fits the budget. Never goes below min_clusters.
+def fit_clusters_to_budget(K, min_clusters, num_sites):
+    if matrix_budget_cells is None:
+        return K
+    if num_sites is None:
+        if matrix_budget_required:
+            raise ValueError("No CCEP3 or CCEP1 sites file found to size the cluster x site matrix. " + \
+                             "Run CCEP1 first, or set matrix_budget_required = False")
+        print("No CCEP1 or CCEP3 sites file found, cluster count is not capped by the matrix budget " + \
+              f"(only by the population threshold). Target number of clusters is {K}")
+        return K
+    
+    max_clusters = matrix_budget_cells // max(num_sites, 1)
+    if K > max_clusters:
+        print(f"Target of {K} clusters exceeds matrix budget of {matrix_budget_cells} cells, " + \
+              f"reducing to {max(max_clusters, min_clusters)}")
+        K = max(max_clusters, min_clusters)
+    
+    num_cells = K * num_sites
+    # FLP model: one continuous var per cluster-site pair, one binary var per site
+    print(f"Projected matrix size = {K} clusters x {num_sites} sites = {num_cells} cells")
+    print(f"Projected FLP model size = {num_cells + num_sites} variables, " + \
+          f"{num_cells + K + num_sites + 1} constraints")
+    return K
+
+def run_module(db, state, county_name, county_code, op_path, srid, ssl, fssl, ip_path, state_code, state_srid, plot=False): 
     
     # Input registered voter data
     ip_path_regvoter = f"{ip_path}\RegisteredVoters"
     ip_regvoter_file = f"{ip_path_regvoter}\{state}_Reg_2016.csv"   
     # Prior file was f"{ip_path_regvoter}\{state}_Reg_{county_code}.2016.csv"   
+    # County-partitioned parquet copy of the state-wide file, created on first use
+    ip_regvoter_cache = f"{ip_path_regvoter}\{state}_Reg_2016_by_county"
     
     # Output of this CCEP2 script
     op_path_ccep2 = f"{op_path}\CCEP2_Master_County_FLP_Files" 
-    op_file_pkl = f"{op_path_ccep2}\{state}_{county_code}_clusters.pkl"
+    op_file_parquet = f"{op_path_ccep2}\{state}_{county_code}_clusters.parquet"
+    # Cluster centers (in the srid used for clustering), for warm-starting the next run
+    op_file_centers = f"{op_path_ccep2}\{state}_{county_code}_cluster_centers.parquet"
+    # Clusters whose blocks changed since the previous run
+    op_file_changes = f"{op_path_ccep2}\{state}_{county_code}_clusters_changed.csv"
     # CSV used only for examing data and debugging
     op_file_csv = f"{op_path_ccep2}\{state}_{county_code}_clusters_temp.csv"
     
     desc = "01 - Read in blocks data for county"
     print(f"{u.getTimeNowStr()} Run: {desc}")
-    df = db.table2df(ssl,f"{county_name}_blocks")    
+    # Only the columns used for clustering, unless all are needed for the debug csv
+    block_columns = None if write_debug_csv else ['blockid10']
+    df = db.table2gdf(ssl,f"{county_name}_blocks",srid,columns=block_columns)    
     print(f"Initial Shape of Blocks Data: {df.shape}")
     # Rename blockid field to geoid for later join to voters
-    df['GEOID'] = [int(i) for i in df.blockid10]
+    df['GEOID'] = pd.to_numeric(df.blockid10).astype('int64')
 
     desc = "02 - Read in registered voter data for county"
     print(f"{u.getTimeNowStr()} Run: {desc}")
-    # Read state-wide voter data
-    voters = pd.read_csv(ip_regvoter_file)
-    # Drop any rows where GEOID, county, or R_totreg_r are NA
-    voters = voters.dropna(subset=['GEOID', 'county', 'R_totreg_r'])    
-    # Extract voter data for this county
+    # Convert the state-wide voter data to a county-partitioned cache, if not done already
+    if voter_cache_is_stale(ip_regvoter_file, ip_regvoter_cache):
+        build_voter_cache(ip_regvoter_file, ip_regvoter_cache)
+    # Extract voter data for this county, reading only its partition
     selection_code = f"{state_code}{county_code}"
-    voters = voters[voters.county == int(selection_code)]    
+    voters = pd.read_parquet(ip_regvoter_cache, filters=[('county', '=', int(selection_code))])
+    # Partition values are read back as categories
+    voters['county'] = voters.county.astype('int64')
     print(f"Shape of Voters Data: {voters.shape}")
 
-    desc = "03 - Join blocks and voters on geoid, and make a geodataframe"
+    desc = "03 - Join blocks (geodataframe) and voters on geoid"
     print(f"{u.getTimeNowStr()} Run: {desc}")
     
     # Join blocks and voters on block id
     df = df.merge(voters, on='GEOID')
     # Num rows will be the smaller of the two. Num cols will be the sum.
     print(f"Shape of Blocks with Voters Data: {df.shape}")
-    df = u.make_gpd(df,srid)
     df['geometry'] = df.geometry.centroid
     df['X'] = df.geometry.x
     df['Y'] = df.geometry.y
@@ -91,6 +254,8 @@ def run_module(db, state, county_name, county_code, op_path, srid, ssl, fssl, ip
     # Note from DK: We always want a certain amount of variation in the clusters, 
     # so even if the voting population onlys supports a low number - we set a minimum of 30
     # E.g. if derived = 11 , then we pick 30. If derived = 79 then we pick 79.
+    # The LA threshold stays while matrix_budget_cells is opt-in (None by default), so that 
+    # LA runs without a budget set don't grow back to a distance matrix that doesn't fit
     if state == "ca" and county_name == "los_angeles":
         population_threshold = 15000 # To reduce size of distance matrix for LA
         print("Using higher population threshold for LA to reduce size of distance matrix")
@@ -104,18 +269,63 @@ def run_module(db, state, county_name, county_code, op_path, srid, ssl, fssl, ip
     K = max(num_clusters,min_clusters) 
     print(f"Num clusters = {num_clusters}, min = {min_clusters}. Target number of clusters is {K}")
 
-    from sklearn.cluster import KMeans
-    # Number of clusters
-    kmeans = KMeans(n_clusters=K)
-    # Fitting the input data
-    kmeans = kmeans.fit(X)
-    # Getting the cluster labels
-    labels = kmeans.predict(X)
+    # Cap the number of clusters so that the CCEP4/CCEP5 cluster x site matrix fits the budget
+    num_sites = expected_num_sites(op_path, state, county_code)
+    K = fit_clusters_to_budget(K, min_clusters, num_sites)
+
+    # Coordinates used for clustering, and the srid they are in
+    if cluster_mode == "weighted":
+        # Cluster in projected coordinates, so distances are in meters
+        projected = df.geometry.to_crs(epsg=int(state_srid))
+        X_cluster = np.column_stack([projected.x.values, projected.y.values])
+        cluster_srid = state_srid
+    else:
+        X_cluster = X
+        cluster_srid = srid
+
+    # Warm start from the centers of the previous run, if they exist and are comparable
+    init_centers = None
+    if cluster_warm_start:
+        init_centers = load_previous_centers(op_file_centers, cluster_srid)
+        if init_centers is not None and len(init_centers) != K:
+            if fits_matrix_budget(len(init_centers), num_sites):
+                # Keep the previous number of clusters, so that labels stay the same across runs
+                print(f"Warm start: using previous number of clusters {len(init_centers)} instead of {K}")
+                K = len(init_centers)
+            else:
+                print(f"Warm start: previous number of clusters {len(init_centers)} exceeds the matrix budget, " + \
+                      f"clustering {K} clusters from random starts")
+                init_centers = None
+
+    if cluster_mode == "weighted":
+        from sklearn.cluster import MiniBatchKMeans
+        print(f"Clustering with MiniBatchKMeans in SRID {state_srid}, weighted by registered voters " + \
+              f"(seed = {cluster_seed}, batch size = {cluster_batch_size})")
+        if init_centers is not None:
+            kmeans = MiniBatchKMeans(n_clusters=K, init=init_centers, n_init=1, 
+                                     random_state=cluster_seed, batch_size=cluster_batch_size)
+        else:
+            kmeans = MiniBatchKMeans(n_clusters=K, random_state=cluster_seed, batch_size=cluster_batch_size)
+        kmeans = kmeans.fit(X_cluster, sample_weight=df.R_totreg_r.values)
+        labels = kmeans.predict(X_cluster)
+    else:
+        from sklearn.cluster import KMeans
+        # Number of clusters
+        if init_centers is not None:
+            kmeans = KMeans(n_clusters=K, init=init_centers, n_init=1)
+        else:
+            kmeans = KMeans(n_clusters=K)
+        # Fitting the input data
+        kmeans = kmeans.fit(X)
+        # Getting the cluster labels
+        labels = kmeans.predict(X)
+    if init_centers is not None:
+        print(f"Warm-started k-means converged in {kmeans.n_iter_} iterations")
     df['cluster_labels'] = labels
     
-    # Centroid values - centroids of new clusters - apprently never used
-    # CCEP4 uses centroids, but creates them
-    #centroids = kmeans.cluster_centers_ 
+    # Centroid values - centroids of new clusters. Not used by CCEP4 (which creates its own 
+    # centroids), but saved in step 05 so that the next run can be warm-started from them
+    centroids = kmeans.cluster_centers_ 
 
     
     # Note: Output cluster file contains centroids of all blocks that did have reg voter data,
@@ -128,8 +338,21 @@ def run_module(db, state, county_name, county_code, op_path, srid, ssl, fssl, ip
     if plot:
         df.plot(column='cluster_labels',figsize=(16,16), alpha=.7,legend=True)
         
-    desc = "05 - Export clusters as .pkl files, and for internal review also as .csv files"
+    desc = "05 - Export clusters as .parquet file, and optionally for internal review also as .csv file"
     print(f"{u.getTimeNowStr()} Run: {desc}")
+    # Only the columns used downstream (CCEP4, CCEP5) are written, with block 
+    # centroids as X/Y float columns instead of geometries
     # Overwrite if it already exists
-    joblib.dump(df, op_file_pkl)
-    df.to_csv(op_file_csv,index=False)
\ No newline at end of file
+    clusters = pd.DataFrame(df[u.CLUSTER_COLUMNS])
+    clusters['GEOID'] = clusters.GEOID.astype('int64')
+    clusters['cluster_labels'] = clusters.cluster_labels.astype('int32')
+    clusters['R_totreg_r'] = clusters.R_totreg_r.astype('float64')
+    # Compare with the previous run before overwriting it, to report blocks that changed cluster
+    if os.path.exists(op_file_parquet):
+        report_cluster_changes(pd.read_parquet(op_file_parquet, columns=['GEOID', 'cluster_labels']), 
+                               clusters, op_file_changes)
+    clusters.to_parquet(op_file_parquet, index=False)
+    pd.DataFrame({'cluster_labels': np.arange(len(centroids)), 'X': centroids[:,0], 'Y': centroids[:,1], 
+                  'srid': str(cluster_srid)}).to_parquet(op_file_centers, index=False)
+    if write_debug_csv:
+        df.to_csv(op_file_csv,index=False)
\ No newline at end of file
@@ -256,9 +256,5 @@ def run_module(db, state, county_name, county_code, op_path, srid, ssl, fssl, ip
     qry_text = f"""drop table if exists {fssl}.{fssl_file};"""
     db.qry(qry_text)
     to_db_df = scored_sites[limit_query].drop('geometry',axis=1)        
-    db.df2table(to_db_df,fssl,fssl_file)
-    qry_text = f"""
-        alter table {fssl}.{fssl_file} add column geom geometry;
-        update {fssl}.{fssl_file} set geom = st_setsrid(st_point(lon, lat),{srid}) ;
-        """
-    db.qry(qry_text)
+    # geom is made from lon, lat while copying, as a typed point column with a spatial index
+    db.df2table_copy(to_db_df,fssl,fssl_file,srid=srid,lon_lat=('lon','lat'),index_columns=['idnum'])
@@ -37,9 +37,9 @@ import geopandas as gpd
 import pandana as pdna
 import shutil
 from sklearn.externals import joblib
-from shapely.geometry import MultiPoint
 import ccep_utils as u
 import ccep_datavars as dv
+import ccep02
 
 # ===================================
 # GLOBAL VARIABLES
@@ -128,14 +128,13 @@ def run_module(db, state, county_name, county_code, op_path, srid, ssl, fssl, ip
     op_file_final_nwk = fr"{op_path}\CCEP4_Final_Network\{state}_{county_code}_clusters2sites_matrix_not_osm_ids.pkl" 
     op_file_cluster_centroids = fr"{op_path}\CCEP4_Cluster_Centroids\{state}_{county_code}_cluster_centroids_df.pkl" 
     
-    ip_cluster_file = fr"{op_path}\CCEP2_Master_County_FLP_Files\{state}_{county_code}_clusters.pkl"
+    ip_cluster_file = fr"{op_path}\CCEP2_Master_County_FLP_Files\{state}_{county_code}_clusters.parquet"
     ip_scored_sites = fr"{op_path}\CCEP3_Master_County_FLP_Files\{state}_{county_code}_all_sites_scored.csv"
     bak_scored_sites = fr"{op_path}\CCEP3_Master_County_FLP_Files\{state}_{county_code}_all_sites_scored_bak_fromCCEP4.csv" 
     
     desc = "01 - Read in county"
     print(f"{u.getTimeNowStr()} Run: {desc}")
-    df_county = db.table2df(ssl,f"{county_name}_county")
-    county_gdf = u.make_gpd(df_county,srid)
+    county_gdf = db.table2gdf(ssl,f"{county_name}_county",srid)
 
     # Load Network from OSM - using bbox set up in ccep_datavars.py
     #
@@ -195,7 +194,7 @@ def run_module(db, state, county_name, county_code, op_path, srid, ssl, fssl, ip
 
     desc = "05 - Load block-voter clusters from CCEP2"
     print(f"{u.getTimeNowStr()} Run: {desc}")    
-    df = joblib.load(ip_cluster_file)
+    df = u.read_clusters(ip_cluster_file, srid, columns=['cluster_labels','X','Y','R_totreg_r'], geometry=plot)
     num_clusters = df.cluster_labels.nunique()
     print(f"Total number of block-voter clusters: {num_clusters}")
     
@@ -208,14 +207,20 @@ def run_module(db, state, county_name, county_code, op_path, srid, ssl, fssl, ip
     desc = "06 - Create cluster centroids for distance calculation"
     print(f"{u.getTimeNowStr()} Run: {desc}")            
     # Note from DK: Take all the block centroids in each cluster and create a cluster centroid 
-    cluster_centroids = {}
-    cluster_centroids_df = []
-    for i in df['cluster_labels'].unique():
-        cluster_points = df[df['cluster_labels'] == i].geometry.tolist()
-        centroid = MultiPoint(cluster_points).centroid
-        cluster_centroids[i] = {'geom': centroid, 'x': centroid.x, 'y':centroid.y}
-        cluster_centroids_df.append([i, centroid])
-    cluster_centroids_df = gpd.GeoDataFrame(cluster_centroids_df,columns=['cluster_id','geometry'])
+    # The centroid of the block centroids (a multipoint) is the mean of their X/Y values.
+    # Clusters are kept in order of first appearance, as in the original loop over unique() labels
+    centroid_xy = df.groupby('cluster_labels', sort=False)[['X','Y']].mean()
+    if ccep02.cluster_mode == "weighted":
+        # CCEP2 placed the cluster centers by registered voters, so the cluster centroid is 
+        # weighted the same way. Clusters without any registered voters keep the plain mean.
+        weighted = df[['X','Y']].multiply(df.R_totreg_r, axis=0)
+        weighted['R_totreg_r'] = df.R_totreg_r
+        sums = weighted.groupby(df.cluster_labels, sort=False).sum()
+        has_voters = sums.R_totreg_r > 0
+        centroid_xy.loc[has_voters, ['X','Y']] = \
+            sums.loc[has_voters, ['X','Y']].div(sums.R_totreg_r[has_voters], axis=0).values
+    cluster_centroids_df = gpd.GeoDataFrame({'cluster_id': centroid_xy.index.values},
+                                            geometry=gpd.points_from_xy(centroid_xy.X, centroid_xy.Y))
 
     desc = "07 A - Assign the closest road nodes to the cluster centroid X/Ys (create near-nodes for clusters)"
     print(f"{u.getTimeNowStr()} Run: {desc}")       
@@ -357,12 +362,26 @@ def run_module(db, state, county_name, county_code, op_path, srid, ssl, fssl, ip
     print(f"Num clusters = {len_clusterdf}, num scored sites = {len_scored_sites}")
     print(f"Expected length of distance matrix = {len_clusterdf * len_scored_sites}")
 
-    # Only re-run this if file doesn't already exist, since it takes a while
-    # for some counties, like Sacramento (20+ mins) and San Mateo (3+ mins)
+    # Only calculate pairs that aren't in an existing file, since it takes a while
+    # for some counties, like Sacramento (20+ mins) and San Mateo (3+ mins).
+    # After CCEP2 re-clusters (e.g. warm-started on refreshed voter data), only clusters 
+    # whose centroid moved to a different near-node need new rows.
+    cluster_nodes = set(cluster_centroids_df.near_node)
+    site_nodes = set(valid_sites.near_node)
     if os.path.exists(op_file_dist_matrix):
-        print(f"Distance matrix exists, will not regenerate. File in {op_file_dist_matrix}")        
-    else:
+        print(f"Distance matrix exists, re-using it. File in {op_file_dist_matrix}")        
+        distance_record.update(joblib.load(op_file_dist_matrix))
+    
+    new_cluster_nodes = [i for i in cluster_nodes if any((i,j) not in distance_record for j in site_nodes)]
+    # Pairs for near-nodes that are no longer used by any cluster or site
+    stale_pairs = [k for k in distance_record if k[0] not in cluster_nodes or k[1] not in site_nodes]
+    print(f"Cluster near-nodes with missing distances = {len(new_cluster_nodes)}, stale pairs to remove = {len(stale_pairs)}")
+    
+    if len(new_cluster_nodes) > 0 or len(stale_pairs) > 0:
+        # build_distances() skips pairs that are already in distance_record
         build_distances(net, edges, cluster_centroids_df,'near_node', valid_sites, 'near_node')
+        for k in stale_pairs:
+            del distance_record[k]
         nearnode_network_distance_matrix = distance_record
         # Save to pickle object
         joblib.dump(nearnode_network_distance_matrix,op_file_dist_matrix)
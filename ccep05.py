@@ -36,13 +36,37 @@ from pyscipopt import multidict, Model, quicksum
 import matplotlib.pyplot as plt
 from scipy.spatial import KDTree
 import ccep_utils as u
+from ccep_siteindex import SiteIndex
 from math import ceil
 import sys
+import time
+import json
 
 # Temporary
 #import matplotlib
 #matplotlib.use('tkagg')
 
+# Candidate sites for 15 min distance mitigation (step 13)
+# "geographic" - 5 nearest scored sites by straight-line distance (original DK method)
+# "travel_time" - 5 scored sites with the lowest travel time from the cluster, from the sorted-site index
+mitigation_candidates = "geographic"
+
+# Cost adjustment by score quantile, used to set up opening costs for the FLP model
+# score_qcut is a series of quantile categories (as strings), e.g. from pd.qcut(...).astype(str)
+def score_cost_adjustment(score_qcut):
+    # For each category range, determine how many values exist, and order by categories
+    # Note: Order is important because cost adjustment assumes bottom quantiles 
+    # are listed first
+    ref_qcuts = score_qcut.value_counts().sort_index()
+    
+    # Do the cost adjustment - Top quantiles are 50% the cost, while 
+    # bottom quantiles are 200% the cost. 
+    cost_adjustment = {}
+    scaling = [2, 1.25, 1, .75, .50]
+    for idx, i in enumerate(ref_qcuts.index):
+        cost_adjustment[i] = scaling[idx]
+    return cost_adjustment
+
 # FLP Model Definition and Execute functions
 
 def flp(I,J,d,M,f,c,k,req_sites=None): 
@@ -74,12 +98,87 @@ def flp(I,J,d,M,f,c,k,req_sites=None):
     model.data = x,y 
     return model
 
-def execute_flp(I, J, d, M, f, c,k, type_of_facility, req_sites=False):
+# Number of non-zero coefficients in the constraint matrix built by flp()
+# (demand, capacity, strong, facility count and required-site rows)
+def flp_nonzeros(I, J, M, req_sites=None):
+    num_pairs = len(I) * len(J)
+    nnz = num_pairs                          # Demand
+    nnz += len(M) * (len(I) + 1)             # Capacity
+    nnz += 2 * num_pairs                     # Strong
+    nnz += len(J)                            # Facilities
+    if req_sites:
+        nnz += len(req_sites)                # Required sites
+    return nnz
+
+# Value of one solver statistic, or None if it can't be read (e.g. a getter missing
+# in this pyscipopt version, or not available for the model's status)
+def solver_stat(get_value, round_to=None):
+    try:
+        value = get_value()
+    except:
+        return None
+    return round(value, round_to) if round_to is not None else value
+
+# Collect model size, timing and bound statistics for one solved FLP model,
+# so they can be written to the per-county run report. Every row has the same
+# columns, with None for statistics that couldn't be read.
+def flp_run_stats(model, type_of_facility, k, n_vars, n_conss, n_nonzeros, build_secs):
+    stats = {
+        'type_of_facility': type_of_facility,
+        'k': int(k),
+        'status': solver_stat(model.getStatus),
+        'n_vars': n_vars,
+        'n_conss': n_conss,
+        'n_nonzeros': n_nonzeros,
+        'build_secs': round(build_secs, 3),
+        }
+    # After solving, these counts refer to the presolved (transformed) problem
+    stats['presolved_vars'] = solver_stat(model.getNVars)
+    stats['presolved_conss'] = solver_stat(model.getNConss)
+    stats['presolve_removed_vars'] = n_vars - stats['presolved_vars'] if stats['presolved_vars'] is not None else None
+    stats['presolve_removed_conss'] = n_conss - stats['presolved_conss'] if stats['presolved_conss'] is not None else None
+    stats['presolve_secs'] = solver_stat(model.getPresolvingTime, 3)
+    stats['solve_secs'] = solver_stat(model.getSolvingTime, 3)
+    stats['n_nodes'] = solver_stat(model.getNNodes)
+    stats['primal_bound'] = solver_stat(model.getPrimalbound)
+    stats['dual_bound'] = solver_stat(model.getDualbound)
+    stats['gap'] = solver_stat(model.getGap)
+    missing = [name for name, value in stats.items() if value is None]
+    if missing:
+        print(f"... unable to read solver statistics {missing} for {type_of_facility}")
+    return stats
+
+# Write the FLP run report (one row per execute_flp call) as both csv and json
+def write_flp_run_report(run_report, state, county_name, county_code, op_file_csv, op_file_json):
+    run_report = [dict({'state': state, 'county_name': county_name, 'county_code': county_code}, **row) 
+                  for row in run_report]
+    # Same columns in every row (e.g. exit_reason only set when the run stopped early)
+    columns = list(dict.fromkeys(col for row in run_report for col in row))
+    run_report = [{col: row.get(col) for col in columns} for row in run_report]
+    pd.DataFrame(run_report).to_csv(op_file_csv, index=False)
+    with open(op_file_json, 'w') as f:
+        json.dump(run_report, f, indent=2, default=str)
+
+# exit_run(reason) is called instead of sys.exit() when the model can't be used,
+# so that run_module can write the run report before stopping
+def execute_flp(I, J, d, M, f, c,k, type_of_facility, req_sites=False, run_report=None, exit_run=None):
+    if exit_run is None:
+        exit_run = lambda reason: sys.exit()
+    t0 = time.time()
     model = flp(I, J, d, M, f, c,k,req_sites=req_sites)
+    build_secs = time.time() - t0
+    # Size of the model as built, i.e. before SCIP presolve
+    n_vars = model.getNVars()
+    n_conss = model.getNConss()
+    n_nonzeros = flp_nonzeros(I, J, M, req_sites=req_sites)
+    print(f"FLP model for {type_of_facility}: {n_vars} variables, {n_conss} constraints, " + \
+          f"{n_nonzeros} nonzeros, built in {round(build_secs, 1)} secs")
     model.optimize()
+    if run_report is not None:
+        run_report.append(flp_run_stats(model, type_of_facility, k, n_vars, n_conss, n_nonzeros, build_secs))
     if model.getStatus() == "infeasible":
         print("Model run is 'infeasible'. This is very likely because of conflicting constraints. Please check, fix, and re-try.")
-        sys.exit()
+        exit_run(f"FLP model for {type_of_facility} is infeasible")
     elif model.getStatus() == "optimal":
         EPS = 1.e-6
         x,y = model.data
@@ -90,13 +189,13 @@ def execute_flp(I, J, d, M, f, c,k, type_of_facility, req_sites=False):
         return {'facilities':facilities, 'edges':edges}
     else:
         print(f"Model returned unexpected status of {model.getStatus()}. Please check, fix, and re-try.")
-        sys.exit()
+        exit_run(f"FLP model for {type_of_facility} returned status {model.getStatus()}")
 
 def run_module(db, state, county_name, county_code, op_path, srid, ssl, fssl, ip_path, county_capacity, site_override, plot=False): 
 
     ip_scored_sites = f"{op_path}\CCEP3_Master_County_FLP_Files\{state}_{county_code}_all_sites_scored.csv"
 
-    ip_cluster_file = f"{op_path}\CCEP2_Master_County_FLP_Files\{state}_{county_code}_clusters.pkl"
+    ip_cluster_file = f"{op_path}\CCEP2_Master_County_FLP_Files\{state}_{county_code}_clusters.parquet"
     ip_file_dist_network = f"{op_path}\CCEP4_Final_Network\{state}_{county_code}_clusters2sites_matrix_not_osm_ids.pkl" 
     ip_file_cluster_centroids = f"{op_path}\CCEP4_Cluster_Centroids\{state}_{county_code}_cluster_centroids_df.pkl" 
 
@@ -110,6 +209,19 @@ def run_module(db, state, county_name, county_code, op_path, srid, ssl, fssl, ip
     # Files created for offline debugging of cluster-site distances - selected sites and all cluster-site pairs
     op_file_cluster_site_distances = f"{op_path_ccep5}\{state}_{county_code}_cluster_site_distances.csv"
     op_file_cluster_site_distances_all = f"{op_path_ccep5}\{state}_{county_code}_cluster_site_distances_all.csv"
+    # Solver telemetry (model size, timings, bounds) for each FLP model run in this module
+    op_file_flp_report_csv = f"{op_path_ccep5}\{state}_{county_code}_flp_run_report.csv"
+    op_file_flp_report_json = f"{op_path_ccep5}\{state}_{county_code}_flp_run_report.json"
+
+    # Solver statistics for each FLP model run, exported in step 15 - or when the
+    # run stops early, with the reason, since those are the runs that need checking
+    flp_run_report = []
+    def exit_run(reason):
+        flp_run_report.append({'status': 'exited', 'exit_reason': reason})
+        write_flp_run_report(flp_run_report, state, county_name, county_code, 
+                             op_file_flp_report_csv, op_file_flp_report_json)
+        print(f"FLP run report written to {op_file_flp_report_csv}")
+        sys.exit()
     
     desc = "01 - Read in scored sites from CCEP3, voter-block clusters from CCEP2, " + \
         "distance matrix and cluster centroids from CCEP4, and county boundary from db"
@@ -130,7 +242,7 @@ def run_module(db, state, county_name, county_code, op_path, srid, ssl, fssl, ip
     cluster_centroids_df = joblib.load(ip_file_cluster_centroids)
     print(f"Size of cluster centroids, i.e. number of clusters = {cluster_centroids_df.shape}")
 
-    block_cluster = joblib.load(ip_cluster_file)
+    block_cluster = u.read_clusters(ip_cluster_file, srid, columns=['cluster_labels','R_totreg_r'])
     print(f"Number of blocks that comprise clusters from CCEP2 = {block_cluster.shape}")
     
     # Delete any rows where cluster label isn't in the CCEP4 cluster centroids output, 
@@ -142,7 +254,7 @@ def run_module(db, state, county_name, county_code, op_path, srid, ssl, fssl, ip
     distance_matrix_network = joblib.load(ip_file_dist_network)
     print(f"Size of distance matrix network = {len(distance_matrix_network)} (cluster centroids x scored sites)")
 
-    county_gdf = u.make_gpd(db.table2df(ssl,f"{county_name}_county"),srid)
+    county_gdf = db.table2gdf(ssl,f"{county_name}_county",srid)
     
     # Note from DK for steps 2, 3 below:
     # Integrate Scores & Adjust Scoring
@@ -160,18 +272,8 @@ def run_module(db, state, county_name, county_code, op_path, srid, ssl, fssl, ip
     # Convert categories to strings
     scored_sites.center_score_qcut = scored_sites.center_score_qcut.astype(str)
 
-    # For each category range, determine how many values exist, and order by categories
-    # Note: Order is important because cost adjustment assumes bottom quantiles 
-    # are listed first
-    ref_qcuts = scored_sites.center_score_qcut.value_counts().sort_index()
-    
-    # Do the cost adjustment - Top quantiles are 50% the cost, while 
-    # bottom quantiles are 200% the cost. 
-    cost_adjustment = {}
-    scaling = [2, 1.25, 1, .75, .50]
-    for idx, i in enumerate(ref_qcuts.index):
-        cost_adjustment[i] = scaling[idx]
     # This creates a dict of ranges of center_scores (5 buckets), with a cost factor for each
+    cost_adjustment = score_cost_adjustment(scored_sites.center_score_qcut)
 
     # Create lookup of cost adjustment for each scored site by idnum    
     scored_sites['center_score_cost_adjustment'] = scored_sites.center_score_qcut.map(cost_adjustment)        
@@ -185,16 +287,8 @@ def run_module(db, state, county_name, county_code, op_path, srid, ssl, fssl, ip
     # Convert categories to strings        
     scored_sites.dropbox_score_qcut = scored_sites.dropbox_score_qcut.astype(str)
     
-    # For each category range, determine how many values exist, and order by categories
-    # Note: Order is important because cost adjustment assumes bottom quantiles 
-    # are listed first
-    ref_qcuts = scored_sites.dropbox_score_qcut.value_counts().sort_index()
-    
-    cost_adjustment = {}
-    scaling = [2, 1.25, 1, .75, .50]
-    for idx, i in enumerate(ref_qcuts.index):
-        cost_adjustment[i] = scaling[idx]
     # This creates a dict of ranges of dropbox_scores (5 buckets), with a cost factor for each
+    cost_adjustment = score_cost_adjustment(scored_sites.dropbox_score_qcut)
 
     # Create lookup of cost adjustment for each scored site by idnum    
     scored_sites['dropbox_cost_adjustment'] = scored_sites.dropbox_score_qcut.map(cost_adjustment)
@@ -268,7 +362,7 @@ def run_module(db, state, county_name, county_code, op_path, srid, ssl, fssl, ip
         print(f"Ten day sites insufficient. Need {ceil(x)} sites (currently {total_required_10day})" + \
                         f" in ccep_datavars, or {ceil(y)} capacity (currently {capacity_tenday})")
         print("***** Exiting script. Please fix the above problem and retry")
-        sys.exit()
+        exit_run(f"Insufficient ten day sites: supply {supply_10day} < demand {ceil(demand)}")
     else:
         print(f"Ten day sites sufficient. Supply = {total_required_10day} x {capacity_tenday} = {supply_10day}, Ratio = {supply_10day/demand}")
     
@@ -279,7 +373,7 @@ def run_module(db, state, county_name, county_code, op_path, srid, ssl, fssl, ip
         print(f"Drop box sites insufficient. Need {ceil(x)} sites (currently {total_required_dropbox})"+ \
                         f" in ccep_datavars, or {ceil(y)} capacity (currently {capacity_dropbox})")
         print("***** Exiting script. Please fix the above problem and retry")        
-        sys.exit()
+        exit_run(f"Insufficient drop box sites: supply {supply_db} < demand {ceil(demand)}")
     else:
         print(f"Drop box sites sufficient. Supply = {total_required_dropbox} x {capacity_dropbox} = {supply_db}, Ratio = {supply_db/demand}")
 
@@ -290,7 +384,7 @@ def run_module(db, state, county_name, county_code, op_path, srid, ssl, fssl, ip
         print(f"Three day sites insufficient. Need {ceil(x)} sites (currently {total_required_vote_sites})" + \
                         f" in ccep_datavars, or {ceil(y)} capacity (currently {county_capacity})")
         print("***** Exiting script. Please fix the above problem and retry")
-        sys.exit()
+        exit_run(f"Insufficient three day sites: supply {supply_3day} < demand {ceil(demand)}")
     else:
         print(f"Three day sites sufficient. Supply = {total_required_vote_sites} x {county_capacity} = {supply_3day}, Ratio = {supply_3day/demand}")        
     print() # Space out the logs...
@@ -345,7 +439,7 @@ def run_module(db, state, county_name, county_code, op_path, srid, ssl, fssl, ip
 
     desc = "07 - Set up the 3-day locations, using FLP model"
     print(f"{u.getTimeNowStr()} Run: {desc}")
-    
+
     # If fixed sites exist, then provide that to model as required sites to include in output
     if len(fs_1day_list) > 0:
         force_sites = fs_1day_list # Will exist for ~ 11 CO counties
@@ -361,7 +455,9 @@ def run_module(db, state, county_name, county_code, op_path, srid, ssl, fssl, ip
         c, 
         total_required_vote_sites, # Note from DK: Include the already identified 10 day sites (for k)
         "3-day sites",
-        req_sites =  force_sites
+        req_sites =  force_sites,
+        run_report = flp_run_report,
+        exit_run = exit_run
        )
     three_day_facilities = three_day_results['facilities']
     
@@ -406,7 +502,9 @@ def run_module(db, state, county_name, county_code, op_path, srid, ssl, fssl, ip
         c, 
         total_required_10day, # Limit for 10-day sites (k)
         "10-day sites",
-        req_sites =  force_sites
+        req_sites =  force_sites,
+        run_report = flp_run_report,
+        exit_run = exit_run
         )
 
     ten_day_facilities = ten_day_results['facilities']
@@ -498,7 +596,9 @@ def run_module(db, state, county_name, county_code, op_path, srid, ssl, fssl, ip
                                                    M_dropbox, 
                                                    f_dropbox, c, 
                                                    total_required_dropbox, # For k
-                                                   "drop box sites")
+                                                   "drop box sites",
+                                                   run_report = flp_run_report,
+                                                   exit_run = exit_run)
         dropbox_facilities = dropbox_sites_network_result['facilities']
         if plot:
             ax = block_cluster.plot(column='cluster_labels',figsize=(20,20), alpha=.7,legend=True)
@@ -525,7 +625,9 @@ def run_module(db, state, county_name, county_code, op_path, srid, ssl, fssl, ip
                                     c, 
                                     total_req_sites_plus10prc, # for k
                                     "additional sites (superset)",
-                                    req_sites = three_day_facilities  # Include the already identified 3 day sites
+                                    req_sites = three_day_facilities,  # Include the already identified 3 day sites
+                                    run_report = flp_run_report,
+                                    exit_run = exit_run
                                    )
     additional_sites = additional_sites_result['facilities']
     # Remove the already selected sites from the list so we just have the additional site(s).
@@ -556,6 +658,14 @@ def run_module(db, state, county_name, county_code, op_path, srid, ssl, fssl, ip
     # avaiable (within a threshold - must be at least 25% less time). So 30 min 
     # vs 31 min minutes wouldn't be selected because the time savings are neglibible. 
     
+    # Sorted-site index over the distance matrix, with the 3-day sites open
+    site_index = SiteIndex.from_distance_matrix(distance_matrix_network, I, J, open_sites=three_day_facilities)
+    # Evaluate the 3-day sites with each cluster at its nearest open site (the FLP model may 
+    # split a cluster across sites to meet capacity, so this can differ from the model edges)
+    nearest_stats = site_index.evaluate(np.array([d[i] for i in I]))
+    print(f"3-day sites, travel time to nearest open site: mean = {np.round(nearest_stats['mean'],2)}, " + \
+          f"voter weighted mean = {np.round(nearest_stats['voter_weighted_mean'],2)}, max = {np.round(nearest_stats['max'],2)}")
+
     # Identify the sites over 15 minutes
     cluster_centroids_df['lon'] = cluster_centroids_df.geometry.x
     cluster_centroids_df['lat'] = cluster_centroids_df.geometry.y
@@ -614,18 +724,23 @@ def run_module(db, state, county_name, county_code, op_path, srid, ssl, fssl, ip
         
         # Find potential additional sites    
         for idx_over15, site in enumerate(over_15_cords):
-            # https://docs.scipy.org/doc/scipy-0.14.0/reference/generated/scipy.spatial.KDTree.query.html
-            distances, indices = tree.query(site,k=5)
+            if mitigation_candidates == "travel_time":
+                # 5 sites with the lowest travel time from this cluster, from the sorted-site index
+                candidate_sites = site_index.nearest_sites(o15_index2id_lookup[idx_over15], n=5)
+            else:
+                # https://docs.scipy.org/doc/scipy-0.14.0/reference/generated/scipy.spatial.KDTree.query.html
+                distances, indices = tree.query(site,k=5)
+                candidate_sites = [vs_index2id_lookup[i] for i in indices]
             current_travel_time = over_15[over_15.cluster_id == o15_index2id_lookup[idx_over15]].traveltime.values[0]
-            for idx, nearby_site in enumerate(indices):
+            for nearby_site in candidate_sites:
                 near_site_travel_time = distance_matrix_network[(o15_index2id_lookup[idx_over15], 
-                                                                    vs_index2id_lookup[nearby_site])]
+                                                                    nearby_site)]
                 if current_travel_time * .75 > near_site_travel_time:
                     print('origin', o15_index2id_lookup[idx_over15],
-                          '- dest', vs_index2id_lookup[nearby_site],\
+                          '- dest', nearby_site,\
                           '- current travel time (nearest vote site)', current_travel_time,\
                           '- near site travel time', near_site_travel_time) 
-                    selected_additional_sites.append(vs_index2id_lookup[nearby_site])
+                    selected_additional_sites.append(nearby_site)
                     break
         selected_additional_sites = list(set(selected_additional_sites))  
 
@@ -698,3 +813,8 @@ def run_module(db, state, county_name, county_code, op_path, srid, ssl, fssl, ip
 
     # Export potential voter sites, for > 15 mins travel time mitigation
     scored_sites[scored_sites.idnum.isin(selected_additional_sites)].to_csv(op_file_addnl_distance,index=False)
+
+    # Export solver telemetry for the FLP model runs
+    write_flp_run_report(flp_run_report, state, county_name, county_code, 
+                         op_file_flp_report_csv, op_file_flp_report_json)
+    print(f"FLP run report written to {op_file_flp_report_csv}")
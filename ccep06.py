@@ -242,9 +242,8 @@ def run_module(db, state, county_name, county_code, op_path, srid, ssl, fssl, st
     print(f"{u.getTimeNowStr()} Run: {desc}")
 
     # Note: This could also be updated to use county-specific tracts
-    tracts = u.make_gpd(db.table2df(admin,f"{state}_tracts"),srid)
-    # Pull out tracts for just this county
-    tracts = tracts[tracts.countyfp == county_code]
+    # Only tracts for this county are read (filtered in the database), streamed in chunks
+    tracts = db.table2gdf(admin,f"{state}_tracts",srid,where=f"countyfp = '{county_code}'",chunksize=20000)
         
     # Remove polygons over water, by removing those with aland <= 0
     tracts['aland'] = tracts['aland'].astype('int64')    
@@ -309,7 +308,7 @@ def run_module(db, state, county_name, county_code, op_path, srid, ssl, fssl, st
     desc = "11 - Save tract geojsons" 
     print(f"{u.getTimeNowStr()} Run: {desc}")
 
-    tracts = u.make_gpd(db.table2df(ssl,f"{county_name}_tracts"), srid)
+    tracts = db.table2gdf(ssl,f"{county_name}_tracts", srid)
     # Needed this conversion, otherwise error: Invalid field type <class 'decimal.Decimal'>
     tracts['shape_leng'] = tracts['shape_leng'].astype('float64')
     tracts['shape_area'] = tracts['shape_area'].astype('float64')
@@ -340,7 +339,7 @@ def run_module(db, state, county_name, county_code, op_path, srid, ssl, fssl, st
     # If we do produce it for the webstite in future, we need to generate it by 
     # dissolving tracts, so that the county boundary doesn't include water polygons, 
     # and matches the tract boundary
-    county = u.make_gpd(db.table2df(ssl,f"{county_name}_county"), srid)
+    county = db.table2gdf(ssl,f"{county_name}_county", srid)
     # Needed this conversion, otherwise error: Invalid field type <class 'decimal.Decimal'>
     county['shape_leng'] = county['shape_leng'].astype('float64') 
     county['shape_area'] = county['shape_area'].astype('float64') 
@@ -369,7 +368,7 @@ def run_module(db, state, county_name, county_code, op_path, srid, ssl, fssl, st
     """    
     db.qry(qry_txt)
     
-    tract_centroid_squares = u.make_gpd(db.table2df(ssl, centroid_file), srid)
+    tract_centroid_squares = db.table2gdf(ssl, centroid_file, srid)
     tract_centroid_squares.to_file(tract_squares_json,driver='GeoJSON')
     '''
 
@@ -377,22 +376,30 @@ def run_module(db, state, county_name, county_code, op_path, srid, ssl, fssl, st
     desc = "13 - Generate POI csv files" 
     print(f"{u.getTimeNowStr()} Run: {desc}")    
     
-    govish_pois = u.make_gpd(db.table2df(ssl,f"{county_name}_pois_gov"),srid)    
-    govish_pois['lon'] = govish_pois.geometry.x
-    govish_pois['lat'] = govish_pois.geometry.y    
-    govish_pois = govish_pois.drop(['geometry', 'gid'],axis=1)    
-    govish_pois = round_df_decimals(govish_pois, ['lat', 'lon'], DEC_PLACES)    
-    govish_pois.to_csv(poi_gov_csv, index='False', encoding='utf-8')
-
-    misc_pois = u.make_gpd(db.table2df(ssl,f"{county_name}_pois_misc"),srid)    
-    misc_pois['lon'] = misc_pois.geometry.x
-    misc_pois['lat'] = misc_pois.geometry.y    
-    misc_pois = misc_pois.drop(['geometry', 'gid'],axis=1)
-    misc_pois = round_df_decimals(misc_pois, ['lat', 'lon'], DEC_PLACES)    
-    misc_pois.to_csv(poi_misc_csv, index=False, encoding='utf-8')
-    
-    # Combine both Gov and Misc POIs into one file
-    misc_pois.append(govish_pois).to_csv(poi_combined_csv, index=False, encoding='utf-8') 
+    # Written straight from the database: all columns of each table except gid and geom, 
+    # then lon, lat rounded to DEC_PLACES
+    pois_gov, pois_misc = f"{county_name}_pois_gov", f"{county_name}_pois_misc"
+    poi_attr_columns = {table: [col for col in db.table_columns(ssl, table) if col not in ['gid','geom']]
+                        for table in [pois_gov, pois_misc]}
+    lon_lat = [f"round(st_x(geom)::numeric, {DEC_PLACES})::float8 lon", 
+               f"round(st_y(geom)::numeric, {DEC_PLACES})::float8 lat"]
+    # Rows are ordered by gid, so the files are the same from run to run
+    db.query2csv(f"{db.select_sql(ssl, pois_gov, poi_attr_columns[pois_gov] + lon_lat)} order by gid", poi_gov_csv)
+    db.query2csv(f"{db.select_sql(ssl, pois_misc, poi_attr_columns[pois_misc] + lon_lat)} order by gid", poi_misc_csv)
+
+    # Combine both Gov and Misc POIs into one file (misc first). Columns are as pandas append 
+    # gave them: the misc file's columns, then any only in gov, empty for the table that doesn't have them
+    gov_only_columns = [col for col in poi_attr_columns[pois_gov] if col not in poi_attr_columns[pois_misc]]
+    combined_columns = poi_attr_columns[pois_misc] + gov_only_columns
+    def combined_select(table, poi_group):
+        columns = [col if col in poi_attr_columns[table] else f"null {col}" for col in combined_columns]
+        return db.select_sql(ssl, table, [f"{poi_group} poi_group", 'gid'] + columns + lon_lat)
+    db.query2csv(f"""
+        select {', '.join(poi_attr_columns[pois_misc] + ['lon', 'lat'] + gov_only_columns)} from (
+            {combined_select(pois_misc, 1)}
+            union all
+            {combined_select(pois_gov, 2)}
+        ) as pois order by poi_group, gid""", poi_combined_csv)
     
     # ========================================================
     # Process files from CCEP3 and CCEP5 - steps 14 - 16
@@ -421,7 +428,7 @@ def run_module(db, state, county_name, county_code, op_path, srid, ssl, fssl, st
     # we are sticking with the file _suitable_sites_processed_final from CCEP3
     
     # Load the buffered circles
-    county_buffered_circles = u.make_gpd(db.table2df(fssl, centroid_file), state_srid)
+    county_buffered_circles = db.table2gdf(fssl, centroid_file, state_srid)
 
 
     desc = "15 - From suitable site (ccep3) and model output (ccep5) files, " + \
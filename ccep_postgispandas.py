@@ -7,15 +7,104 @@ Created on Fri Nov 15 15:40:18 2019
 Created based on DK's Postgis Pandas package, for interacting with Postgres/Postgis and Python Pandas
 """
 from sqlalchemy import * #TODO: Confirm if any other imports other than create_engine are needed
+from sqlalchemy import exc
+from sqlalchemy.pool import QueuePool
+from contextlib import contextmanager
+import datetime
+import gzip
+import hashlib
+import io
+import json
+import os
+import re
+import threading
+import time
 import pandas as pd
+import numpy as np
+import geopandas as gpd
+import ccep_utils as u
+
+# Postgres truncates identifiers longer than this
+MAX_IDENTIFIER_LEN = 63
+
+# Written for nulls in df2table_copy's csv, so that empty strings stay empty strings
+# (in csv COPY, an empty unquoted field is otherwise read as null)
+COPY_NULL = r"\N"
+
+# auto_explain settings for the query log (see enable_query_log). The plans are sent to 
+# the client as notices (log_level needs postgres 12+), so they can be logged with the query.
+AUTO_EXPLAIN_SETTINGS = {
+    'auto_explain.log_analyze': 'on',
+    'auto_explain.log_buffers': 'on',
+    'auto_explain.log_format': 'json',
+    'auto_explain.log_level': 'notice',
+    }
+
+def split_sql(q):
+    """
+    Split sql text into its statements, on semicolons that are not inside 
+    quotes ('...' or "..."), dollar quotes ($$...$$, $tag$...$tag$), or comments
+    """
+    statements = []
+    start = i = 0
+    n = len(q)
+    while i < n:
+        c = q[i]
+        if c in ("'", '"'):
+            # Quoted string or identifier, a doubled quote is an escaped quote
+            i += 1
+            while i < n:
+                if q[i] == c:
+                    if i + 1 < n and q[i + 1] == c:
+                        i += 2
+                        continue
+                    break
+                i += 1
+            i += 1
+        elif c == '-' and q.startswith('--', i):
+            end = q.find('\n', i)
+            i = n if end == -1 else end + 1
+        elif c == '/' and q.startswith('/*', i):
+            end = q.find('*/', i + 2)
+            i = n if end == -1 else end + 2
+        elif c == '$':
+            tag = re.match(r"\$[A-Za-z_]?[A-Za-z0-9_]*\$", q[i:])
+            if tag:
+                end = q.find(tag.group(0), i + len(tag.group(0)))
+                i = n if end == -1 else end + len(tag.group(0))
+            else:
+                i += 1
+        elif c == ';':
+            statements.append(q[start:i])
+            i += 1
+            start = i
+        else:
+            i += 1
+    statements.append(q[start:])
+    # Drop empty statements (and ones that are only comments/whitespace)
+    return [s.strip() for s in statements 
+            if re.sub(r"--[^\n]*|/\*.*?\*/", "", s, flags=re.DOTALL).strip()]
 
 private = {}
 class postgis_pandas(object):
-    #TODO: Update description
     """ 
+    Connection to the Postgres/Postgis database, with helpers to run queries and 
+    move data between tables and (geo)pandas.
+
+    Connections come from a pool (QueuePool). Each thread gets its own connection (self.con),
+    so counties/modules can be run in parallel threads with one postgis_pandas object. 
+    For parallel processes, create a postgis_pandas in each process (e.g. with clone()).
+    
+    db_params: dict of dbname, host, port, user, pwd
+    pool_size, max_overflow: connections kept in the pool, and extra ones allowed when busy
+    statement_timeout_ms: cancel any statement that runs longer than this (None for no limit)
+    
+    Can be used as a context manager, which closes all connections at the end:
+        with postgis_pandas(db_info) as db:
+            ...
     """
     #TODO: Re-include app_paths=app_paths if needed
-    def __init__(self, db_params, do_echo=True):
+    def __init__(self, db_params, do_echo=True, pool_size=5, max_overflow=10, statement_timeout_ms=None):
 
         private[self,'dbhost'] = db_params.get("host")
         private[self,'dbuser'] = db_params.get("user")
@@ -25,36 +114,233 @@ class postgis_pandas(object):
         self.dbport = db_params.get("port")
         self.pwd_cmd="export PGPASSWORD=" + '"' + private[self,'dbpwd'] + '"'
         #self.app_paths = app_paths
+        self.settings = dict(do_echo=do_echo, pool_size=pool_size, max_overflow=max_overflow, 
+                             statement_timeout_ms=statement_timeout_ms)
         
         cmd = f"postgresql://{private[self,'dbuser']}:" + \
             f"{private[self,'dbpwd']}@{private[self,'dbhost']}:{self.dbport}/{self.dbname}" 
-        self.engine = create_engine(cmd, echo = do_echo, encoding='utf-8')
+        connect_args = {}
+        if statement_timeout_ms:
+            connect_args['options'] = f"-c statement_timeout={int(statement_timeout_ms)}"
+        # pool_pre_ping checks a pooled connection before handing it out, and replaces it if dropped
+        self.engine = create_engine(cmd, echo = do_echo, encoding='utf-8', poolclass=QueuePool,
+                                    pool_size=pool_size, max_overflow=max_overflow, 
+                                    pool_pre_ping=True, connect_args=connect_args)
+        self._local = threading.local()
+        self._pid = os.getpid()
+        # Query log (see enable_query_log), off by default
+        self.query_log_file = None
+        self._query_log_lock = threading.Lock()
 
-        # Close a preexisting connection (if instantiating a new instance)
-        print('Closing existing connection if one exists')
-        try:
-            self.con.close()
-        except:
-            print('No existing connection to close')
-
-        # Open a new connection
+        # Open a connection for this thread, to check the database is reachable
         print('Opening new connection')
         try:
-            self.con = self.engine.connect()
+            self.con
             print("Python<-->DB Connection Succeeded")
         except:
             print("Python<-->DB Connection Failed")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.dispose()
+
+    # New postgis_pandas with the same settings, e.g. for a worker process
+    def clone(self):
+        db_params = {"dbname": self.dbname, "port": self.dbport, "host": private[self,'dbhost'],
+                     "user": private[self,'dbuser'], "pwd": private[self,'dbpwd']}
+        return postgis_pandas(db_params, **self.settings)
+
+    # This thread's connection, checked out from the pool when first used
+    @property
+    def con(self):
+        if os.getpid() != self._pid:
+            # Pooled connections can't be shared with a forked process, start a new pool
+            self.engine.dispose()
+            self._local = threading.local()
+            self._pid = os.getpid()
+        con = getattr(self._local, 'con', None)
+        if con is None or con.closed:
+            con = self.engine.connect()
+            self._local.con = con
+        return con
+
+    # Return this thread's connection to the pool
+    def close(self):
+        con = getattr(self._local, 'con', None)
+        if con is not None:
+            try:
+                con.close()
+            except:
+                print('... closing connection failed')
+            self._local.con = None
+
+    # Replace this thread's connection, e.g. after the server dropped it
+    def reconnect(self):
+        con = getattr(self._local, 'con', None)
+        if con is not None:
+            try:
+                con.invalidate()
+            except:
+                pass
+        self.close()
+        return self.con
+
+    # Close all pooled connections
+    def dispose(self):
+        self.close()
+        self.engine.dispose()
+
+    # Gives the calling (worker) thread its own connection for the with block, and returns 
+    # it to the pool at the end:
+    #     with db.connection():
+    #         ccep01.run_module(db, ...)
+    @contextmanager
+    def connection(self):
+        self.con
+        try:
+            yield self
+        finally:
+            self.close()
     
-    def qry(self, q):
-        return self.con.execute(text(q))
+    # Log every statement run by qry() (and so run_query) to a JSON lines file: the step
+    # description, a hash of the sql, duration and rows affected. For statements that take
+    # slow_query_secs or longer, the plan with actual times, rows and buffers is logged too, 
+    # if explain_slow. The plan comes from auto_explain (EXPLAIN (ANALYZE, BUFFERS) as the 
+    # statement runs, create table ... as included), so statements are never run twice.
+    # auto_explain has to be loadable by the db user (e.g. postgres), and log_analyze adds 
+    # some timing overhead to every statement while logging.
+    # Statements sent together are run one by one while logging, each committed as it
+    # would be on its own (unless in a transaction).
+    def enable_query_log(self, log_file, slow_query_secs=60, explain_slow=True):
+        self.query_log_file = log_file
+        self.slow_query_secs = slow_query_secs
+        self.explain_slow = explain_slow
+        print(f"Logging queries to {log_file}")
+
+    # auto_explain is turned off on this thread's connection. Other pooled connections keep 
+    # it until they are closed.
+    def disable_query_log(self):
+        self.query_log_file = None
+        if self.con.info.get('auto_explain_min_duration_ms'):
+            self._execute("SET auto_explain.log_min_duration = -1", autocommit=True)
+            self.con.info.pop('auto_explain_min_duration_ms')
+
+    def _log_query(self, record):
+        with self._query_log_lock:
+            with open(self.query_log_file, 'a') as f:
+                f.write(json.dumps(record, default=str) + "\n")
+
+    # If the connection was lost (and no transaction was open), reconnect and run the query again
+    # autocommit: commit after the statement (if not in a transaction), whatever the statement is.
+    # By default SQLAlchemy only autocommits statements like insert/update/create/drop.
+    def _execute(self, q, autocommit=False):
+        statement = text(q).execution_options(autocommit=True) if autocommit else text(q)
+        try:
+            return self.con.execute(statement)
+        except exc.DBAPIError as e:
+            if e.connection_invalidated and not self.con.in_transaction():
+                print("... connection lost, reconnecting and retrying")
+                self.reconnect()
+                return self.con.execute(statement)
+            raise
+
+    # Load and set up auto_explain on this thread's connection, if not done already. Returns 
+    # False if it can't be loaded (e.g. not a superuser), and slow statements are logged without plans.
+    # Settings made in a transaction are undone if it rolls back, so they are only marked 
+    # as done on the connection outside transactions.
+    def _setup_auto_explain(self):
+        min_duration_ms = int(self.slow_query_secs * 1000)
+        done = self.con.info.get('auto_explain_min_duration_ms')
+        if done is False or done == min_duration_ms:
+            return done is not False
+        settings = dict(AUTO_EXPLAIN_SETTINGS, **{'auto_explain.log_min_duration': str(min_duration_ms)})
+        setup = ["LOAD 'auto_explain'"] + [f"SET {name} = '{value}'" for name, value in settings.items()]
+        try:
+            if self.con.in_transaction():
+                with self.con.begin_nested():
+                    for q in setup:
+                        self._execute(q)
+                return True
+            for q in setup:
+                self._execute(q, autocommit=True)
+        except:
+            print("... auto_explain could not be loaded, slow queries are logged without plans")
+            self.con.info['auto_explain_min_duration_ms'] = False
+            return False
+        self.con.info['auto_explain_min_duration_ms'] = min_duration_ms
+        return True
+
+    # Plan sent by auto_explain while the last statement ran (as JSON), the last one if several
+    def _auto_explain_plan(self, notices):
+        plans = [n for n in notices if "plan:" in n]
+        if not plans:
+            return None
+        plan = plans[-1]
+        try:
+            return json.loads(plan[plan.index("{", plan.index("plan:")):])
+        except ValueError:
+            return plan
+
+    def _logged_execute(self, statement, desc):
+        sql_hash = hashlib.sha1(" ".join(statement.split()).encode('utf-8')).hexdigest()[:12]
+        explain = self.explain_slow and self._setup_auto_explain()
+        if explain:
+            notices = self.con.connection.notices
+            del notices[:]
+        t0 = time.time()
+        result = self._execute(statement, autocommit=True)
+        duration = time.time() - t0
+        rowcount = result.rowcount
+        slow = duration >= self.slow_query_secs
+        plan = self._auto_explain_plan(self.con.connection.notices) if explain and slow else None
+        self._log_query({
+            'time': datetime.datetime.now().isoformat(timespec='seconds'),
+            'pid': os.getpid(),
+            'thread': threading.current_thread().name,
+            'desc': desc,
+            'sql_hash': sql_hash,
+            'sql': statement[:2000],
+            'duration_secs': round(duration, 3),
+            'rowcount': rowcount,
+            'slow': slow,
+            'plan': plan,
+            })
+        return result
+
+    # desc: description of the step, for the query log
+    def qry(self, q, desc=None):
+        if self.query_log_file is None:
+            return self._execute(q)
+        result = None
+        for statement in split_sql(q):
+            if result is not None:
+                result.close()
+            result = self._logged_execute(statement, desc)
+        return result
+
+    # Start a transaction on the connection, so several statements are committed together.
+    # Call commit() (or rollback()) on the returned transaction, or use it in a with block.
+    # A failed statement aborts the whole transaction in postgres, so helpers that otherwise
+    # ignore errors (add_column, create_index, analyze) raise them in a transaction.
+    def transaction(self):
+        return self.con.begin()
+
+    # Re-raise the error being handled, if in a transaction
+    def _raise_in_transaction(self):
+        if self.con.in_transaction():
+            raise
     
     # Used 4-5 times in CCEP1    
+    # Errors are printed and ignored, except in a transaction (see transaction())
     def add_column(self, schema, table, column_name, column_type):
         try:
             self.qry(f"""ALTER TABLE {schema}.{table} ADD COLUMN {column_name} {column_type};""")
             print(f"... add column {column_name} succeeded")
         except:
             print(f"... add column {column_name} failed")            
+            self._raise_in_transaction()
             
     # Copy from col2 to col1 where joinid_1 = joinid_2
     # ... col1 has to exist, and the 2 col datatypes have to match
@@ -69,19 +355,47 @@ class postgis_pandas(object):
             """
         self.qry(qry_txt)
     
+    # Index name from the table and column names, so each table gets its own indexes
+    # (e.g. counties processed at the same time don't share an index name).
+    # Names too long for postgres are shortened, with a hash to keep them unique.
+    def index_name(self, table, columns, method='btree'):
+        name = f"{table.split('.')[-1]}_{'_'.join(columns)}_{method}_idx".lower()
+        if len(name) > MAX_IDENTIFIER_LEN:
+            name_hash = hashlib.md5(name.encode('utf-8')).hexdigest()[:8]
+            name = f"{name[:MAX_IDENTIFIER_LEN - 9]}_{name_hash}"
+        return name
+
+    # Create an index if it doesn't already exist (i.e. not dropped and recreated)
+    # table: schema.table, columns: list of column names, method: e.g. btree or gist
+    def create_index(self, table, columns, method='btree'):
+        if isinstance(columns, str):
+            columns = [columns]
+        name = self.index_name(table, columns, method)
+        try:
+            self.qry(f"""CREATE INDEX IF NOT EXISTS {name} ON {table} USING {method}({', '.join(columns)});""")
+            print(f"... index {name} ready")
+        except:
+            # e.g. another process created the same index at the same time, or the column doesn't exist
+            print(f"... create index {name} failed")
+            self._raise_in_transaction()
+        return name
+
+    # Update planner statistics, e.g. after creating a table
+    def analyze(self, table):
+        try:
+            self.con.execute(text(f"""ANALYZE {table};""").execution_options(autocommit=True))
+        except:
+            print(f"... analyze {table} failed")
+            self._raise_in_transaction()
+
     # Used only twice, both times in CCEP1
+    # unlogged: create the output as an UNLOGGED table (e.g. for scratch tables)
     def intersect(self, output_schema_name, input_schema_name1, id_1, label_1, \
-                  input_schema_name2, id_2, label_2):
-        output_schema = output_schema_name.split('.')[0]
-        a_schema = input_schema_name1.split('.')[0]
-        b_schema = input_schema_name2.split('.')[0]
+                  input_schema_name2, id_2, label_2, unlogged=False):
+        self.create_index(input_schema_name1, ['geom'], 'gist')
+        self.create_index(input_schema_name2, ['geom'], 'gist')
         qry_txt = f"""	
-            DROP INDEX IF EXISTS {a_schema}.a_gdx;
-    		DROP INDEX IF EXISTS {b_schema}.b_gdx;
-    		CREATE INDEX a_gdx ON {input_schema_name1}  USING GIST(geom);
-    		CREATE INDEX b_gdx ON {input_schema_name2} USING GIST(geom);
-
-    		CREATE TABLE {output_schema_name} AS 
+    		CREATE {'UNLOGGED' if unlogged else ''} TABLE {output_schema_name} AS 
     		SELECT
     		  a.{id_1} AS {label_1}_gid,
     		  b.{id_2} AS {label_2}_gid,
@@ -95,22 +409,86 @@ class postgis_pandas(object):
     		ON ST_Intersects(a.geom, b.geom)
             """
         self.qry(qry_txt)
-
-        # TODO: This wasn't used, is it needed? Commented until we confirm
-        # cleanup = """drop index {}.a_gdx, {}.b_gdx;"""
+        self.create_index(output_schema_name, [f'{label_1}_gid'])
+        self.create_index(output_schema_name, [f'{label_2}_gid'])
+        self.analyze(output_schema_name)
         
         #TODO: Check if this is needed, doesn't appear to be
         #if return_df:
         #	return self.table2df(output_schema, output_schema_name.split('.')[1])
     # End intersect()
 
+    # Select statement for table2df/iter_table
+    # columns: list of column names (all if None), where: sql condition, e.g. "countyfp = '067'"
+    def select_sql(self, schema, table, columns=None, where=None):
+        cols = ", ".join(columns) if columns else "*"
+        where_clause = f" where {where}" if where else ""
+        return f"""select {cols} from {schema}.{table}{where_clause}"""
+
     # Used in multiple CCEP files
-    def table2df(self, schema, table):
-        tempcon =  self.qry(f"""select * from {schema}.{table}""")
+    # With chunksize, rows are streamed from a server-side cursor in chunks (see iter_table), 
+    # so the full list of rows is never held in memory alongside the df
+    def table2df(self, schema, table, columns=None, where=None, chunksize=None):
+        if chunksize:
+            return pd.concat(self.iter_table(schema, table, columns, where, chunksize), ignore_index=True)
+        tempcon =  self.qry(self.select_sql(schema, table, columns, where))
         df = pd.DataFrame(tempcon.fetchall(), columns = tempcon.keys())
         tempcon.close()
         return df
 
+    # Column names of a table, in order
+    def table_columns(self, schema, table):
+        result = self.qry(f"""select column_name from information_schema.columns 
+            where table_schema = '{schema}' and table_name = '{table}' order by ordinal_position""")
+        return [row[0] for row in result.fetchall()]
+
+    # Read a table with geometry into a GeoDataFrame (same as make_gpd(table2df(...)), 
+    # with the geometry in a column named geometry). The geometry is sent as binary WKB 
+    # (ST_AsBinary) instead of hex text, and decoded for the whole column in one call.
+    # srid: srid of the geometry column
+    # columns, where, chunksize: as in table2df. geom is added to columns if missing
+    # transform_srid: transform the geometry to this srid in the database (ST_Transform)
+    # precision: snap coordinates to this grid size in the database (ST_ReducePrecision, PostGIS 3.1+)
+    def table2gdf(self, schema, table, srid, columns=None, where=None, chunksize=None, 
+                  geom_col='geom', transform_srid=None, precision=None):
+        if columns is None:
+            columns = self.table_columns(schema, table)
+        columns = [col for col in columns if col != geom_col]
+        geom_expr = geom_col
+        if transform_srid is not None:
+            geom_expr = f"st_transform({geom_expr}, {transform_srid})"
+        if precision is not None:
+            geom_expr = f"st_reduceprecision({geom_expr}, {precision})"
+        df = self.table2df(schema, table, columns + [f"st_asbinary({geom_expr}) {geom_col}"], 
+                           where, chunksize)
+        # bytea comes back as memoryview
+        wkb = df.pop(geom_col).map(bytes, na_action='ignore')
+        crs = f"EPSG:{transform_srid if transform_srid is not None else srid}"
+        return gpd.GeoDataFrame(df, crs=crs, geometry=u.geoms_from_wkb(wkb.values))
+
+    # Yield the (selected) rows of a table in chunks of chunksize rows, as DataFrames, or as 
+    # pyarrow RecordBatches if arrow=True. Uses a server-side cursor, so memory use depends on 
+    # chunksize, not the table size. Always yields at least one (possibly empty) chunk.
+    def iter_table(self, schema, table, columns=None, where=None, chunksize=50000, arrow=False):
+        if arrow:
+            import pyarrow as pa # Only needed for arrow output
+        result = self.con.execution_options(stream_results=True).execute(
+            text(self.select_sql(schema, table, columns, where)))
+        keys = result.keys()
+        try:
+            first = True
+            while True:
+                rows = result.fetchmany(chunksize)
+                if not rows and not first:
+                    break
+                first = False
+                df = pd.DataFrame(rows, columns = keys)
+                yield pa.RecordBatch.from_pandas(df, preserve_index=False) if arrow else df
+                if len(rows) < chunksize:
+                    break
+        finally:
+            result.close()
+
     # Used once each in CCEP1 and CCEP3
     def df2table(self, df, schema, newname, append=False, create_index=False):
         """
@@ -131,6 +509,111 @@ class postgis_pandas(object):
             except:
                 print('... no geom column exists, or geometry column not named geom.')
 
+    def df2table_copy(self, df, schema, newname, append=False, srid=None, geometry=None, 
+                      lon_lat=None, index_columns=None, analyze=True, chunksize=100000):
+        """
+        Same as df2table, but streams the rows with COPY FROM STDIN (csv) instead of INSERTs,
+        and can add point geometry as a typed geometry(Point, srid) column named geom.
+        df: the df that you want to upload to the db
+        schema: destination schema
+        newname: name of the table
+        append: if inserting rows into an existing table set append = True
+        srid: srid of the geometry
+        geometry: name of a column in df with shapely points, or
+        lon_lat: tuple of the lon and lat column names in df, to make points from
+        index_columns: list of columns to create (btree) indexes on. geom gets a gist index.
+        analyze: run ANALYZE on the table afterwards
+        """
+        df = df.copy()
+        geom = None
+        if geometry is not None:
+            geom = df.pop(geometry).to_numpy()
+        elif lon_lat is not None:
+            geom = np.asarray(gpd.points_from_xy(df[lon_lat[0]].values, df[lon_lat[1]].values), dtype=object)
+            # Missing lon/lat gives null geometry, as st_point does
+            geom[(df[lon_lat[0]].isnull() | df[lon_lat[1]].isnull()).values] = None
+        
+        table = f"{schema}.{newname}"
+        # Empty table with the df's columns and types (as df2table would create it)
+        df.head(0).to_sql(name=newname, schema=schema, con=self.con, index=False, 
+                          if_exists='append' if append else 'fail')
+        if geom is not None:
+            if not append:
+                self.qry(f"""ALTER TABLE {table} ADD COLUMN geom geometry(Point, {srid});""")
+            # Geometry is sent as hex EWKB, which postgis parses directly
+            df['geom'] = u.geoms_to_ewkb_hex(geom, srid)
+        
+        text_cols = df.columns[df.dtypes == object]
+        if (df[text_cols] == COPY_NULL).any().any():
+            raise ValueError(f"Values equal to the null marker {COPY_NULL} can't be copied to {table}, use df2table")
+        columns = ", ".join(f'"{col}"' for col in df.columns)
+        copy_sql = f"""COPY {table} ({columns}) FROM STDIN WITH (FORMAT csv, NULL '{COPY_NULL}')"""
+        # Use the same connection (e.g. sees tables created in an open transaction)
+        dbapi_con = self.con.connection
+        cursor = dbapi_con.cursor()
+        try:
+            for start in range(0, len(df), chunksize):
+                buf = io.StringIO()
+                df.iloc[start:start + chunksize].to_csv(buf, header=False, index=False, na_rep=COPY_NULL)
+                buf.seek(0)
+                cursor.copy_expert(copy_sql, buf)
+        except:
+            self._rollback_copy(dbapi_con)
+            raise
+        finally:
+            cursor.close()
+        if not self.con.in_transaction():
+            dbapi_con.commit()
+        print(f"... copied {len(df)} rows to {table}")
+
+        for col in index_columns or []:
+            self.create_index(table, [col])
+        if geom is not None:
+            self.create_index(table, ['geom'], 'gist')
+        if analyze:
+            self.analyze(table)
+
+    # After a failed COPY, postgres has aborted the (implicit) transaction psycopg2 started for it.
+    # Roll it back so the connection can be used again. In a transaction(), rolling back is left 
+    # to its owner (e.g. a with block), which sees the error.
+    def _rollback_copy(self, dbapi_con):
+        if not self.con.in_transaction():
+            try:
+                dbapi_con.rollback()
+            except:
+                print("... rollback after failed copy failed")
+
+    # Write the results of a select query straight to a csv file, streamed by the database
+    # with COPY (query) TO STDOUT, so memory use doesn't depend on the number of rows.
+    # Do any column selection or rounding in the query. 
+    # The file is gzipped if op_file ends with .gz
+    def query2csv(self, query, op_file, header=True):
+        query = query.strip().rstrip(';')
+        copy_sql = f"""COPY ({query}) TO STDOUT WITH (FORMAT csv, HEADER {'true' if header else 'false'})"""
+        opener = gzip.open if op_file.endswith('.gz') else open
+        dbapi_con = self.con.connection
+        try:
+            with opener(op_file, 'wb') as f:
+                cursor = dbapi_con.cursor()
+                try:
+                    cursor.copy_expert(copy_sql, f)
+                finally:
+                    cursor.close()
+        except:
+            self._rollback_copy(dbapi_con)
+            # Don't leave a partial file behind
+            if os.path.exists(op_file):
+                os.remove(op_file)
+            raise
+        # End the implicit transaction psycopg2 started for the copy
+        if not self.con.in_transaction():
+            dbapi_con.commit()
+        print(f"... query written to {op_file}")
+
+    # Same as query2csv, for (selected columns and rows of) a table
+    def table2csv(self, schema, table, op_file, columns=None, where=None, header=True):
+        self.query2csv(self.select_sql(schema, table, columns, where), op_file, header)
+
     # Added for manual debugging and error handling
     def see_all_processes(self):
         out = self.qry("""select datid,datname, pid,usename,application_name,query_start,state,query from pg_stat_activity""").fetchall()
@@ -18,7 +18,9 @@ state/county that were specified in ccep_datavars
 import time
 import ccep_utils as u
 import ccep_datavars as dv # for dict of states and counties
+from ccep_postgispandas import postgis_pandas
 import ccep01
+import ccep01_local
 import ccep02
 import ccep03
 import ccep04
@@ -37,6 +39,15 @@ modules_to_run = ["CCEP1"]
 # Whether or not to display plots
 displayPlot = False
 
+# Run CCEP1 once per state for all its counties (ccep01.run_statewide), instead of 
+# once per county. Writes the same per-county tables and csv files.
+ccep1_statewide = False
+
+# CCEP1 backend: "postgis" (ccep01), or "local" (ccep01_local) to compute the 
+# suitable site csv in memory from local files, without the database. 
+# The local backend only writes the csv, not the county tables used by later modules.
+ccep1_backend = "postgis"
+
 
 #============================
 # Set up paths and variables
@@ -54,8 +65,6 @@ mts_in_pt05mile = "800"
 # DB access and connection
 #=========================
 
-db_config_file = "ccep_postgispandas.py"
-
 #TODO: Take password from user, don't hardcode it here
 db_info = {
     "dbname": "ccep",
@@ -65,11 +74,19 @@ db_info = {
     "pwd": "" # Enter password here before running
     }
 
+# Cancel any single statement that runs longer than this (None for no limit)
+statement_timeout_ms = None
+
 # Open connection to DB
-with open(db_config_file) as f:
-    code = compile(f.read(), db_config_file, 'exec')
-    exec(code, globals(), locals())    
-db = postgis_pandas(db_info,do_echo=False) # class in ccep_postgispandas.py, via db_config_file
+db = postgis_pandas(db_info,do_echo=False,statement_timeout_ms=statement_timeout_ms)
+
+# Query log: set to a directory to log every sql statement (duration, rows, and query 
+# plans for statements slower than slow_query_secs, from auto_explain - see 
+# postgis_pandas.enable_query_log) to a JSON lines file for this run
+query_log_path = None # e.g. f"{op_path}\Query_Logs"
+slow_query_secs = 60
+if query_log_path is not None:
+    db.enable_query_log(f"{query_log_path}\ccep_queries_{u.getTimeNowStrForDirs()}.jsonl", slow_query_secs)
 
 #=====================
 # Functions
@@ -96,23 +113,35 @@ if __name__ == '__main__':
         counties = dv.states.get(state)[0]
         state_srid = dv.states.get(state)[1]
         state_code = dv.states.get(state)[2]
+        ssl = f"{dv.ssl}_{state}"
+        fssl = f"{dv.fssl}_{state}"
+        
+        if "CCEP1" in modules_to_run and ccep1_statewide and ccep1_backend == "postgis":
+            print(f"\n{u.getTimeNowStr()} Running CCEP1 statewide with {state.upper()}, {len(counties)} counties...")
+            t0 = time.time()
+            county_codes = {county_name: counties.get(county_name)[0] for county_name in counties}
+            ccep01.run_statewide(db, state, county_codes, op_path, srid, ssl, fssl, state_srid, mts_in_pt05mile)
+            minutes = u.getTimeDiffInMinutes(t0)
+            print(f"\n{u.getTimeNowStr()} CCEP1 statewide for {state.upper()} finished in {minutes} mins")
+        
         for county_name in counties:
             county_code = counties.get(county_name)[0]
             county_bbox = counties.get(county_name)[1] # For CCEP4
             county_capacity = counties.get(county_name)[2] # For CCEP5
             county_site_override = counties.get(county_name)[3] # For CCEP5
             
-            ssl = f"{dv.ssl}_{state}"
-            fssl = f"{dv.fssl}_{state}"
-            
             for module in modules_to_run:
+                if module == "CCEP1" and ccep1_statewide and ccep1_backend == "postgis":
+                    continue # Already run for the state above
                 print(f"\n{u.getTimeNowStr()} Running {module} with {state.upper()}, {county_name}, {county_code}...")
                 t0 = time.time()
                 
-                if module == "CCEP1":
+                if module == "CCEP1" and ccep1_backend == "local":
+                    ccep01_local.run_module(state, county_name, county_code, op_path, srid, state_srid, mts_in_pt05mile, ip_path)
+                elif module == "CCEP1":
                     ccep01.run_module(db, state, county_name, county_code, op_path, srid, ssl, fssl, state_srid, mts_in_pt05mile)
                 elif module == "CCEP2":
-                    ccep02.run_module(db, state, county_name, county_code, op_path, srid, ssl, fssl, ip_path, state_code, plot=displayPlot) 
+                    ccep02.run_module(db, state, county_name, county_code, op_path, srid, ssl, fssl, ip_path, state_code, state_srid, plot=displayPlot) 
                 elif module == "CCEP3":
                     ccep03.run_module(db, state, county_name, county_code, op_path, srid, ssl, fssl, ip_path, plot=displayPlot) 
                 elif module == "CCEP4":
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Oct 20 10:02:11 2026
+
+@author: Gorgonio
+
+Per-cluster sorted-site index, for finding each cluster's nearest open site.
+
+For every cluster, the scored sites are sorted once by travel cost (from the
+CCEP4 distance matrix). A pointer per cluster marks its current best open site,
+so looking up the nearest open site is O(1). When a site opens or closes, only
+the clusters it affects are updated:
+- opening a site moves the pointer back for clusters that rank it ahead of their current best
+- closing a site moves the pointer forward for clusters whose current best it was
+
+Used by the what-if service, and for candidate sites in CCEP5 distance mitigation.
+"""
+
+import numpy as np
+
+# Travel cost used when a cluster/site pair is missing from the distance matrix
+# (same value CCEP4 uses when no path exists)
+NO_PATH_COST = 99999.0
+
+class SiteIndex(object):
+    """
+    cluster_ids: list of cluster ids (rows)
+    site_ids: list of site idnums (columns)
+    cost: 2d numpy array of travel cost, clusters x sites
+    open_sites: optional list of site idnums that are open to start with
+    """
+    def __init__(self, cluster_ids, site_ids, cost, open_sites=None):
+        self.cluster_ids = list(cluster_ids)
+        self.site_ids = list(site_ids)
+        self.site_pos = {site_id: pos for pos, site_id in enumerate(self.site_ids)}
+        self.cluster_pos = {cluster_id: pos for pos, cluster_id in enumerate(self.cluster_ids)}
+        self.cost = cost
+        num_clusters, num_sites = cost.shape
+        self.rows = np.arange(num_clusters)
+
+        # Site positions sorted by travel cost, for each cluster (stable, so ties keep site order)
+        self.order = np.argsort(cost, axis=1, kind='mergesort').astype('int32')
+        # rank[c, s] = position of site s in cluster c's sorted order
+        self.rank = np.empty_like(self.order)
+        self.rank[self.rows[:, None], self.order] = np.arange(num_sites, dtype='int32')
+
+        # Pointer into self.order for each cluster's best open site.
+        # A value of num_sites means the cluster has no open site.
+        self.is_open = np.zeros(num_sites, dtype=bool)
+        self.ptr = np.full(num_clusters, num_sites, dtype='int32')
+        if open_sites:
+            self.set_open_sites(open_sites)
+
+    @classmethod
+    def from_distance_matrix(cls, distance_matrix_network, cluster_ids, site_ids, open_sites=None):
+        """Build the index from the CCEP4 dict of {(cluster_id, site_id): cost}"""
+        cluster_pos = {cluster_id: pos for pos, cluster_id in enumerate(cluster_ids)}
+        site_pos = {site_id: pos for pos, site_id in enumerate(site_ids)}
+        cost = np.full((len(cluster_pos), len(site_pos)), NO_PATH_COST)
+        for (cluster_id, site_id), cost_val in distance_matrix_network.items():
+            if cluster_id in cluster_pos and site_id in site_pos:
+                cost[cluster_pos[cluster_id], site_pos[site_id]] = cost_val
+        return cls(cluster_ids, site_ids, cost, open_sites=open_sites)
+
+    def set_open_sites(self, open_sites):
+        """Reset the index so that exactly these site idnums are open"""
+        num_sites = len(self.site_ids)
+        self.is_open[:] = False
+        self.is_open[[self.site_pos[i] for i in open_sites]] = True
+        # First open site in each cluster's sorted order
+        open_in_order = self.is_open[self.order]
+        has_open = open_in_order.any(axis=1)
+        self.ptr = np.where(has_open, open_in_order.argmax(axis=1), num_sites).astype('int32')
+
+    def open_site(self, site_id):
+        """Open a site. Returns positions of the clusters that are now assigned to it"""
+        s = self.site_pos[site_id]
+        if self.is_open[s]:
+            return np.array([], dtype='int64')
+        self.is_open[s] = True
+        affected = np.nonzero(self.rank[:, s] < self.ptr)[0]
+        self.ptr[affected] = self.rank[affected, s]
+        return affected
+
+    def close_site(self, site_id):
+        """Close a site. Returns positions of the clusters that had to be reassigned"""
+        s = self.site_pos[site_id]
+        if not self.is_open[s]:
+            return np.array([], dtype='int64')
+        self.is_open[s] = False
+        num_sites = len(self.site_ids)
+        affected = np.nonzero(self.rank[:, s] == self.ptr)[0]
+        # Walk each affected cluster forward to its next open site
+        pending = affected
+        while len(pending) > 0:
+            self.ptr[pending] += 1
+            at_end = self.ptr[pending] >= num_sites
+            still_closed = ~at_end
+            still_closed[still_closed] = ~self.is_open[self.order[pending[still_closed], self.ptr[pending[still_closed]]]]
+            pending = pending[still_closed]
+        return affected
+
+    def snapshot(self):
+        """Save the open/closed state, e.g. to undo a what-if change"""
+        return (self.is_open.copy(), self.ptr.copy())
+
+    def restore(self, snapshot):
+        self.is_open, self.ptr = snapshot[0].copy(), snapshot[1].copy()
+
+    def open_site_ids(self):
+        return [self.site_ids[s] for s in np.nonzero(self.is_open)[0]]
+
+    def best_site_pos(self):
+        """Position (column) of each cluster's nearest open site, -1 if none is open"""
+        num_sites = len(self.site_ids)
+        has_open = self.ptr < num_sites
+        best = np.full(len(self.cluster_ids), -1, dtype='int64')
+        best[has_open] = self.order[self.rows[has_open], self.ptr[has_open]]
+        return best
+
+    def best_cost(self):
+        """Travel cost from each cluster to its nearest open site, inf if none is open"""
+        best = self.best_site_pos()
+        costs = np.full(len(self.cluster_ids), np.inf)
+        costs[best >= 0] = self.cost[self.rows[best >= 0], best[best >= 0]]
+        return costs
+
+    def nearest_sites(self, cluster_id, n=5, open_only=False):
+        """The n site idnums with the lowest travel cost from a cluster, nearest first"""
+        order = self.order[self.cluster_pos[cluster_id]]
+        if open_only:
+            order = order[self.is_open[order]]
+        return [self.site_ids[s] for s in order[:n]]
+
+    def evaluate(self, demand):
+        """
+        Travel time stats for the current open sites, with each cluster
+        assigned to its nearest open site. demand is in cluster order.
+        """
+        costs = self.best_cost()
+        return {
+            'num_open_sites': int(self.is_open.sum()),
+            'travel_cost': float((demand * costs).sum()),
+            'mean': float(costs.mean()),
+            'voter_weighted_mean': float((demand * costs).sum() / demand.sum()),
+            'max': float(costs.max()),
+            }
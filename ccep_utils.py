@@ -7,8 +7,13 @@ Created on Fri Nov 15 17:16:40 2019
 
 import time
 import datetime
+import concurrent.futures
+import pandas as pd
 import geopandas as gpd
-from shapely import wkb
+import shapely
+
+# Columns in the CCEP2 cluster file. X/Y are block centroid coordinates (in srid)
+CLUSTER_COLUMNS = ['GEOID', 'cluster_labels', 'R_totreg_r', 'X', 'Y']
 
 # Provide t0 as a unit of time (time.time())
 def getTimeDiffInMinutes(t0):
@@ -31,22 +36,89 @@ def getTimeNowStrForDirs():
 def run_query(description, db, query_text):
     t0 = time.time()
     print(f"{getTimeNowStr()} Run query: {description}") # add ,end =  " " to print finish on same line
-    db.qry(query_text)
+    db.qry(query_text, desc=description)
     minutes = getTimeDiffInMinutes(t0)
     print(f"... finished in {minutes} mins")
 
+def run_queries_parallel(db, steps, deps, max_workers=4):
+    """
+    Run queries concurrently, each on its own connection (from db's pool), 
+    starting each one as soon as the queries it depends on have finished.
+    steps: dict of step id: (description, query text)
+    deps: dict of step id: list of step ids it needs (ids not in steps are ignored)
+    If a query fails, no more are started, and the error is raised once running ones finish.
+    """
+    def run_step(step):
+        description, query_text = steps[step]
+        with db.connection():
+            run_query(description, db, query_text)
+
+    t0 = time.time()
+    print(f"{getTimeNowStr()} Run {len(steps)} queries, up to {max_workers} at a time")
+    pending = {step: [d for d in deps.get(step, []) if d in steps] for step in steps}
+    done = set()
+    running = {}
+    error = None
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending or running:
+            if error is None:
+                for step in [step for step, needs in pending.items() if set(needs) <= done]:
+                    running[executor.submit(run_step, step)] = step
+                    del pending[step]
+            if not running:
+                break
+            finished, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                step = running.pop(future)
+                if future.exception() is not None:
+                    print(f"... {step} failed: {future.exception()}")
+                    error = error or future.exception()
+                else:
+                    done.add(step)
+    if error is not None:
+        raise error
+    if pending:
+        raise ValueError(f"Queries with unmet dependencies: {list(pending)}")
+    minutes = getTimeDiffInMinutes(t0)
+    print(f"... all queries finished in {minutes} mins")
+
+# shapely 2 decodes/encodes a whole array of geometries in one call. The environment in 
+# the README (python 3.6) has shapely 1, where this is done one geometry at a time.
+SHAPELY_2 = hasattr(shapely, 'from_wkb')
+
+def geoms_from_wkb(values):
+    """Shapely geometries from an array of WKB (bytes) or hex WKB (str). None stays None"""
+    if SHAPELY_2:
+        return shapely.from_wkb(values)
+    from shapely import wkb
+    return [None if v is None else wkb.loads(v, hex=isinstance(v, str)) for v in values]
+
+def geoms_to_ewkb_hex(geoms, srid):
+    """Hex EWKB (WKB with the srid, as PostGIS reads it) of an array of shapely geometries. None stays None"""
+    if SHAPELY_2:
+        return shapely.to_wkb(shapely.set_srid(geoms, int(srid)), hex=True, include_srid=True)
+    from shapely import wkb
+    return [None if g is None else wkb.dumps(g, hex=True, srid=int(srid)) for g in geoms]
+
 def make_gpd(df, srid, fromPostgis=True):
     """Converts Pandas Dataframes to GeoPandas GeoDataFrames """    
+    crs = f"EPSG:{srid}"
     if fromPostgis:
-        geometry = df['geom'].apply(lambda x: wkb.loads(x, hex=True))
+        # Decode the whole column of PostGIS (hex) WKB in one call (with shapely 2)
+        geometry = geoms_from_wkb(df['geom'].values)
         df = df.drop('geom', axis=1)
-        crs = {'init': f'epsg:{srid}'}
         return gpd.GeoDataFrame(df, crs=crs, geometry=geometry)
     else:
-        from shapely.geometry import Point
-        # TODO: Confirm that this works for CCEP4/5/6 - i.e. no list() or dict() around zip()
-        # It works fine for ccep3. Geometry is displayed in df variable, but does not 
-        # get used in module.
-        geometry = [Point(xy) for xy in zip(df.lon, df.lat)]
-        crs = {'init': f'epsg:{srid}'}
+        geometry = gpd.points_from_xy(df.lon, df.lat)
         return gpd.GeoDataFrame(df, crs=crs, geometry=geometry)
+
+def read_clusters(cluster_file, srid, columns=None, geometry=True):
+    """Reads the CCEP2 cluster file (parquet), optionally only the given columns.
+    If geometry is True, returns a GeoDataFrame with block centroid points built from X/Y"""
+    if columns is not None and geometry:
+        columns = list(columns) + [c for c in ['X', 'Y'] if c not in columns]
+    df = pd.read_parquet(cluster_file, columns=columns)
+    if not geometry:
+        return df
+    crs = f"EPSG:{srid}"
+    return gpd.GeoDataFrame(df, crs=crs, geometry=gpd.points_from_xy(df.X, df.Y))
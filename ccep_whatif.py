@@ -0,0 +1,366 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 09:12:30 2026
+
+@author: Gorgonio
+
+Interactive "what-if" siting service for one county.
+
+Counties often ask what happens if a site is forced open, or an existing site
+is closed. Rather than re-running CCEP5 by hand, this script loads the county's
+CCEP3/CCEP4/CCEP5 outputs once, keeps them in memory, and answers requests with
+forced-open and forced-closed site lists.
+
+Two modes are supported for each request:
+- "assign" (default): apply the changes to the 3-day sites chosen by CCEP5, and
+  assign each cluster to its nearest open site. This ignores site capacity, and
+  returns in well under a second even for large counties.
+- "resolve": re-solve the 3-day FLP model with the forced sites fixed open/closed.
+  The model is built once on the first request and then re-used, only the site
+  bounds are changed between requests. Slower, but respects capacity.
+
+In both modes the county's fixed sites (CO 1-day fixed sites, that CCEP5 forces
+open in the 3-day model) stay open, and cannot be forced closed.
+
+Requests can be sent to a local HTTP server (POST /whatif), or, for testing
+without the website, dropped as .json files into a request directory.
+
+Sample request:
+    {"forced_open": [1234], "forced_closed": [567, 890], "mode": "assign"}
+
+** NOTE **
+It can only be run on counties for which CCEP5 has already been run.
+"""
+
+import os
+import json
+import time
+import numpy as np
+import pandas as pd
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from sklearn.externals import joblib
+import ccep_utils as u
+import ccep_datavars as dv
+import ccep05
+from ccep_siteindex import SiteIndex
+
+#============================
+# Set up paths and variables
+#============================
+
+# Same as ccep_processing.py
+op_path = r"P:\proj_a_d\CCEP\Vote Center Siting Tool\data\CCEPScriptOutputs"
+
+# County to serve
+state = "ca"
+county_name = "napa"
+
+# HTTP server, only bound to the local machine
+host = "localhost"
+port = 8765
+
+# If set, serve requests from files in this directory instead of over HTTP
+# Responses are written next to each request as <request name>_response.json
+request_dir = None
+
+# Travel time threshold (same as CCEP5 distance mitigation)
+travel_time_threshold = 15
+
+# Keep re-solves interactive; the best solution found so far is returned at the limit
+resolve_time_limit_secs = 30
+
+#=====================
+# Functions
+#=====================
+
+class WhatIfCounty(object):
+    """
+    Holds the cost matrix, demand, opening costs and CCEP5 3-day solution
+    for one county in memory, and evaluates forced-open/forced-closed requests
+    """
+    def __init__(self, state, county_name, op_path):
+        county_code = dv.states.get(state)[0].get(county_name)[0]
+        self.state = state
+        self.county_name = county_name
+        self.county_code = county_code
+        self.county_capacity = dv.states.get(state)[0].get(county_name)[2]
+        self.model = None
+
+        ip_scored_sites = fr"{op_path}\CCEP3_Master_County_FLP_Files\{state}_{county_code}_all_sites_scored.csv"
+        ip_cluster_file = fr"{op_path}\CCEP2_Master_County_FLP_Files\{state}_{county_code}_clusters.parquet"
+        ip_file_dist_network = fr"{op_path}\CCEP4_Final_Network\{state}_{county_code}_clusters2sites_matrix_not_osm_ids.pkl"
+        ip_file_cluster_centroids = fr"{op_path}\CCEP4_Cluster_Centroids\{state}_{county_code}_cluster_centroids_df.pkl"
+        ip_file_3day = fr"{op_path}\CCEP5_Master_County_FLP_Files\{state}_{county_code}_four_day_sites.csv"
+
+        t0 = time.time()
+        print(f"{u.getTimeNowStr()} Loading CCEP outputs for {state.upper()}, {county_name}, {county_code}...")
+
+        # Same filters on scored sites as CCEP5
+        scored_sites = pd.read_csv(ip_scored_sites)
+        scored_sites = scored_sites[scored_sites.center_score.notnull()]
+        scored_sites = scored_sites[scored_sites.droppoff_score.notnull()]
+
+        # Same opening costs for 3-day sites as CCEP5
+        center_score_qcut = pd.qcut(scored_sites.center_score,[0,.2,.4,.6,.8,1]).astype(str)
+        cost_adjustment = ccep05.score_cost_adjustment(center_score_qcut)
+        scored_sites['opening_cost'] = 12000 * center_score_qcut.map(cost_adjustment)
+
+        # Demand by cluster, for clusters that CCEP4 kept
+        cluster_centroids_df = joblib.load(ip_file_cluster_centroids)
+        block_cluster = u.read_clusters(ip_cluster_file, None, columns=['cluster_labels','R_totreg_r'], geometry=False)
+        block_cluster = block_cluster.loc[block_cluster['cluster_labels'].isin(cluster_centroids_df['cluster_id'])]
+        demand = block_cluster.groupby('cluster_labels').R_totreg_r.sum()
+
+        self.cluster_ids = demand.index.tolist()
+        self.site_ids = scored_sites.idnum.tolist()
+        self.site_pos = {site_id: pos for pos, site_id in enumerate(self.site_ids)}
+        self.demand = demand.values.astype('float64')
+        self.opening_cost = scored_sites.opening_cost.values.astype('float64')
+
+        # Fixed sites that CCEP5 step 07 forces open in the 3-day model (CO only)
+        self.fixed_sites = []
+        if state == "co":
+            self.fixed_sites = scored_sites[scored_sites.fs_1day == 1].idnum.tolist()
+
+        # Starting point for all requests - the 3-day sites selected by CCEP5
+        self.baseline_sites = [i for i in pd.read_csv(ip_file_3day).idnum.tolist() if i in self.site_pos]
+        self.baseline_sites += [i for i in self.fixed_sites if i not in self.baseline_sites]
+
+        # Sorted-site index over the cluster x site cost matrix, with the 3-day sites open
+        distance_matrix_network = joblib.load(ip_file_dist_network)
+        self.index = SiteIndex.from_distance_matrix(distance_matrix_network, self.cluster_ids, 
+                                                    self.site_ids, open_sites=self.baseline_sites)
+        self.cost = self.index.cost
+
+        minutes = u.getTimeDiffInMinutes(t0)
+        print(f"Loaded {len(self.cluster_ids)} clusters, {len(self.site_ids)} sites, " + \
+              f"{len(self.baseline_sites)} 3-day sites, {len(self.fixed_sites)} fixed sites in {minutes} mins")
+
+    def check_sites(self, site_ids):
+        unknown = [i for i in site_ids if i not in self.site_pos]
+        if len(unknown) > 0:
+            raise ValueError(f"Unknown site idnums (not in CCEP3 scored sites): {unknown}")
+
+    def summarize(self, open_sites, assigned_pos, mode, t0, extra=None):
+        """Build the response: assignment, objective and travel time stats"""
+        # Clusters with assigned_pos -1 (e.g. no demand served in a re-solve) are reported
+        # as unassigned, and left out of the costs and travel time stats
+        rows = np.arange(len(self.cluster_ids))
+        assigned = assigned_pos >= 0
+        travel_time = np.full(len(rows), np.nan)
+        travel_time[assigned] = self.cost[rows[assigned], assigned_pos[assigned]]
+        assigned_time = travel_time[assigned]
+        assigned_demand = self.demand[assigned]
+        open_pos = [self.site_pos[i] for i in open_sites]
+        travel_cost = float((assigned_demand * assigned_time).sum())
+        opening_cost = float(self.opening_cost[open_pos].sum())
+        over_threshold = assigned_time > travel_time_threshold
+        if assigned.any():
+            travel_time_stats = {
+                'mean': float(assigned_time.mean()),
+                'voter_weighted_mean': float((assigned_demand * assigned_time).sum() / assigned_demand.sum()) \
+                    if assigned_demand.sum() > 0 else None,
+                'median': float(np.median(assigned_time)),
+                'p90': float(np.percentile(assigned_time, 90)),
+                'max': float(assigned_time.max()),
+                f'clusters_over_{travel_time_threshold}': int(over_threshold.sum()),
+                f'voters_over_{travel_time_threshold}': float(assigned_demand[over_threshold].sum()),
+                }
+        else:
+            travel_time_stats = None
+        response = {
+            'state': self.state,
+            'county_name': self.county_name,
+            'county_code': self.county_code,
+            'mode': mode,
+            'open_sites': sorted(int(i) for i in open_sites),
+            'objective': travel_cost + opening_cost,
+            'travel_cost': travel_cost,
+            'opening_cost': opening_cost,
+            'travel_time_stats': travel_time_stats,
+            'unassigned_clusters': [int(self.cluster_ids[i]) for i in rows[~assigned]],
+            'assignment': [{'cluster_id': int(self.cluster_ids[i]),
+                            'site_id': int(self.site_ids[assigned_pos[i]]) if assigned[i] else None,
+                            'travel_time': float(travel_time[i]) if assigned[i] else None} for i in rows],
+            }
+        if extra:
+            response.update(extra)
+        response['elapsed_secs'] = round(time.time() - t0, 3)
+        return response
+
+    def assign(self, forced_open, forced_closed):
+        """Apply changes to the CCEP5 3-day sites, and assign each cluster to its nearest open site"""
+        t0 = time.time()
+        # Only clusters affected by each change are reassigned; the index is reset afterwards
+        baseline = self.index.snapshot()
+        try:
+            for j in forced_open:
+                self.index.open_site(j)
+            for j in forced_closed:
+                self.index.close_site(j)
+            open_sites = self.index.open_site_ids()
+            assigned_pos = self.index.best_site_pos()
+        finally:
+            self.index.restore(baseline)
+        if len(open_sites) == 0:
+            raise ValueError("No open sites left after applying forced-closed sites")
+        return self.summarize(open_sites, assigned_pos, "assign", t0)
+
+    def build_model(self):
+        """Build the 3-day FLP model once, same inputs as CCEP5 step 07"""
+        t0 = time.time()
+        print(f"{u.getTimeNowStr()} Building 3-day FLP model for re-solves...")
+        I = self.cluster_ids
+        J = self.site_ids
+        d = dict(zip(I, self.demand))
+        M = {j: self.county_capacity for j in J}
+        f = dict(zip(J, self.opening_cost))
+        c = {(i,j): self.cost[ipos, jpos] for ipos, i in enumerate(I) for jpos, j in enumerate(J)}
+        req_sites = self.fixed_sites if len(self.fixed_sites) > 0 else None
+        self.model = ccep05.flp(I, J, d, M, f, c, len(self.baseline_sites), req_sites=req_sites)
+        self.model.hideOutput()
+        self.model.setRealParam('limits/time', resolve_time_limit_secs)
+        minutes = u.getTimeDiffInMinutes(t0)
+        print(f"...finished in {minutes} mins")
+
+    def resolve(self, forced_open, forced_closed):
+        """Re-solve the 3-day FLP model with forced sites fixed open or closed"""
+        if self.model is None:
+            self.build_model()
+        t0 = time.time()
+        model = self.model
+        x,y = model.data
+        # Drop the previous solve, so that bounds can be changed on the original problem
+        model.freeTransform()
+        for j in y:
+            lb = 1 if (j in forced_open or j in self.fixed_sites) else 0
+            ub = 0 if j in forced_closed else 1
+            model.chgVarLb(y[j], lb)
+            model.chgVarUb(y[j], ub)
+        model.optimize()
+        status = model.getStatus()
+        if model.getNSols() == 0:
+            raise ValueError(f"Re-solve returned status '{status}' with no solution. " + \
+                             "Forced sites may conflict with the number of sites or capacity.")
+        EPS = 1.e-6
+        open_sites = [j for j in y if model.getVal(y[j]) > EPS]
+        # Report each cluster against the open site serving most of its demand
+        assigned_pos = np.full(len(self.cluster_ids), -1, dtype='int64')
+        served = np.zeros(len(self.cluster_ids))
+        cluster_pos = {cluster_id: pos for pos, cluster_id in enumerate(self.cluster_ids)}
+        for (i,j) in x:
+            val = model.getVal(x[i,j])
+            if val > served[cluster_pos[i]]:
+                served[cluster_pos[i]] = val
+                assigned_pos[cluster_pos[i]] = self.site_pos[j]
+        extra = {'status': status, 'gap': model.getGap(), 'flp_objective': model.getObjVal()}
+        return self.summarize(open_sites, assigned_pos, "resolve", t0, extra=extra)
+
+    def handle(self, request):
+        """Evaluate one request dict, and return the response dict"""
+        if not isinstance(request, dict):
+            raise ValueError("Request must be a JSON object")
+        forced_open = [int(i) for i in request.get('forced_open', [])]
+        forced_closed = [int(i) for i in request.get('forced_closed', [])]
+        self.check_sites(forced_open + forced_closed)
+        both = set(forced_open) & set(forced_closed)
+        if len(both) > 0:
+            raise ValueError(f"Sites cannot be both forced open and forced closed: {sorted(both)}")
+        fixed_closed = set(forced_closed) & set(self.fixed_sites)
+        if len(fixed_closed) > 0:
+            raise ValueError(f"Fixed sites are always open, and cannot be forced closed: {sorted(fixed_closed)}")
+        mode = request.get('mode', 'assign')
+        if mode == 'assign':
+            return self.assign(forced_open, forced_closed)
+        elif mode == 'resolve':
+            return self.resolve(forced_open, forced_closed)
+        else:
+            raise ValueError(f"Unsupported mode '{mode}'. Please use 'assign' or 'resolve'")
+
+
+def make_handler(county):
+    class WhatIfHandler(BaseHTTPRequestHandler):
+        def send_json(self, code, body):
+            data = json.dumps(body).encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path == '/status':
+                self.send_json(200, {'state': county.state, 'county_name': county.county_name,
+                                     'county_code': county.county_code,
+                                     'num_clusters': len(county.cluster_ids),
+                                     'num_sites': len(county.site_ids),
+                                     'baseline_sites': sorted(int(i) for i in county.baseline_sites)})
+            else:
+                self.send_json(404, {'error': f"Unknown path {self.path}"})
+
+        def do_POST(self):
+            if self.path != '/whatif':
+                self.send_json(404, {'error': f"Unknown path {self.path}"})
+                return
+            try:
+                length = int(self.headers.get('Content-Length', 0))
+                request = json.loads(self.rfile.read(length) or b'{}')
+                response = county.handle(request)
+            except (ValueError, TypeError) as e:
+                # Bad request body (including invalid json), or sites that can't be used
+                self.send_json(400, {'error': str(e)})
+                return
+            except Exception as e:
+                # e.g. a solver error in resolve mode
+                print(f"{u.getTimeNowStr()} Request failed: {repr(e)}")
+                self.send_json(500, {'error': f"Request failed: {repr(e)}"})
+                return
+            self.send_json(200, response)
+    return WhatIfHandler
+
+# Serve over HTTP, until interrupted
+def serve_http(county, host, port):
+    server = HTTPServer((host, port), make_handler(county))
+    print(f"{u.getTimeNowStr()} What-if service listening on http://{host}:{port} (POST /whatif, GET /status)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("Stopping what-if service")
+    server.server_close()
+
+# File-based stand-in for the website. Picks up any .json request in
+# request_dir that doesn't yet have a response, polling until interrupted
+def serve_files(county, request_dir, poll_secs=1):
+    print(f"{u.getTimeNowStr()} What-if service watching {request_dir} for .json requests")
+    try:
+        while True:
+            for name in sorted(os.listdir(request_dir)):
+                if not name.endswith('.json') or name.endswith('_response.json'):
+                    continue
+                op_file = os.path.join(request_dir, name[:-len('.json')] + '_response.json')
+                if os.path.exists(op_file):
+                    continue
+                try:
+                    with open(os.path.join(request_dir, name)) as f:
+                        request = json.load(f)
+                    response = county.handle(request)
+                except (ValueError, TypeError) as e:
+                    response = {'error': str(e)}
+                except Exception as e:
+                    response = {'error': f"Request failed: {repr(e)}"}
+                with open(op_file, 'w') as f:
+                    json.dump(response, f, indent=2)
+                print(f"{u.getTimeNowStr()} Answered {name}, written to {op_file}")
+            time.sleep(poll_secs)
+    except KeyboardInterrupt:
+        print("Stopping what-if service")
+
+#=====================
+# Execution
+#=====================
+if __name__ == '__main__':
+    county = WhatIfCounty(state, county_name, op_path)
+    if request_dir:
+        serve_files(county, request_dir)
+    else:
+        serve_http(county, host, port)